@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 import getpass  ## import getpass is required if prompting for XIQ crednetials
+import csv
+import heapq
 import json
 import requests
+from requests.adapters import HTTPAdapter
 from colored import fg
 import os
-import smtplib
-import pandas as pd
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email.utils import formatdate
-from email import encoders
+import random
+import sys
+import threading
+import time
+from itertools import repeat
+## Heavier modules are imported by the functions that use them so a run only pays for the features it has enabled:
+## asyncio (asyncMode), concurrent.futures (parallelPagination, tenantMode), tempfile (CSV spill files), smtplib/email/zipfile (emailFeature), sqlite3 (snapshotFeature),
+## pyarrow (columnarReport), cProfile/pstats/tracemalloc (profileMode)
 
 ########################################################################################################################
 ## written by:       Mike Rieben
@@ -23,6 +27,30 @@ from email import encoders
 ## v1:  Initial release with no capabilities of modifying device configuration
 ## v2:  Added capabilities of updating devices with a delta config when a member of a specific CCG
 ## v2a: Bug fix for XIQ-Site Engine connected devices without certain parameters returned via API
+## v2b: Added optional parallel pagination for the Online/Offline device sweeps
+##      All XIQ API calls share one pooled keep-alive HTTP session with connection reuse statistics
+##      Added optional asyncio run mode that overlaps the offline sweep with the online update chain
+##      CCG membership is held in a hash index (CcgMemberIndex) instead of list scans
+##      Added optional targeted CCG member query for the update path with a slower full fleet report schedule
+##      Added optional field projection for the device sweeps with an estimate of the bytes saved versus views=FULL
+##      CSV rows are streamed to disk and sorted with a bounded-memory external merge sort, pandas is no longer required
+##      Optional feature modules (asyncio, smtplib/email, concurrent.futures) are imported only when used
+##      Added optional SQLite snapshot so runs report only added/removed/changed devices and skip unchanged reports
+##      Added watch mode that repeats the audit on an interval with warm connections, token and CCG ID
+##      Added optional on-disk access token cache with refresh before expiry and one re-authentication on a 401
+##      Deployments are sent in concurrent chunks; devices of failed chunks stay in the CCG
+##      Added optional adaptive rate limiter shared by all API calls that honors 429/Retry-After and retries throttled calls
+##      Added optional multi-tenant mode that audits several XIQ organizations in parallel worker processes with a consolidated summary
+##      The CCG search stops at the page holding ccgName and the CCG ID is kept in a file so later runs fetch the CCG directly
+##      Added optional list of several update CCGs (ccgNames) handled by one CCG search and one device sweep, one CSV column per CCG
+##      The sweeps produce compact slotted DeviceRecord objects instead of one dict per device
+##      Both sweeps share one page-at-a-time column normalizer (NormalizeDevicePage) with the same missing-field handling
+##      Added optional typed Parquet/Arrow report appended to a run history folder, written from the same device records as the CSV
+##      The email attaches the zipped CSV and is queued in a local outbox that a separate sender process (--drain-outbox) delivers with retries
+##      Added optional run metrics (phase times, per endpoint latency histograms, bytes, retries, rows) as a Prometheus textfile and JSON summary
+##      Added optional profiling mode writing CPU hot function and allocation site reports next to the CSV
+##      Added optional sweep planner that sizes every device sweep with a count probe, skips empty sweeps and picks page size and workers
+##      Failed page requests are retried with jittered exponential backoff; optional sweep checkpoint lets an interrupted run resume its sweeps
 # ########################################################################################################################
 ## This script ...  See README.md file for full description 
 ########################################################################################################################
@@ -43,11 +71,10 @@ from email import encoders
 # XIQ_username = "name@contoso.com"  # Enter your ExtremeCloudIQ Username "xxxx"
 # XIQ_password = "<password>"  # Enter your ExtremeCLoudIQ password "xxxx"
 
-## 2) Prompt user to enter credentials, must have empty token variable (Uncomment 4 total lines below), simply uncomment - no entries required
+## 2) Prompt user to enter credentials when the audit starts, must have empty token, username and password variables (Uncomment 3 total lines below), simply uncomment - no entries required
 # XIQ_Token = ""
-# print ("Enter your XIQ login credentials ")
-# XIQ_username = input("Email: ")
-# XIQ_password = getpass.getpass("Password: ")
+# XIQ_username = ""
+# XIQ_password = ""
 
 ## 3) TOKEN generation from api.extremecloudiq.com (Swagger). Must have empty username and password variables (Uncomment 3 total lines below).  Enter XIQ Toekn within "" only.
 XIQ_Token = "XXXXXXX"
@@ -55,8 +82,16 @@ XIQ_username = ""
 XIQ_password = ""
 ##Authentication Options END
 
+##Token cache - Only used with options 1 & 2 above (username/password).  Keeps the access token in a file readable only by your user account and
+##reuses it on the next runs until shortly before it expires, instead of calling /login every run.
+tokenCacheFeature = 'DISABLE' # Default: 'DISABLE' logs in every run.  'ENABLE' to reuse the cached token until it expires.
+tokenRefreshMarginSeconds = 300  #<-- get a new token this many seconds before the current one expires
+
 ##Cloud Config Group Name - CCG must match XIQ for script to run successfully or an error will arise
 ccgName = 'UpdateOfflineDevices'
+##Several update CCGs, e.g. one per region or maintenance window:  ccgNames = ['UpdateEast','UpdateWest'].  Every CCG must exist in XIQ.  One CCG search
+##and one device sweep cover all of them, each CCG gets its own CSV column, deployment and CCG update.  When the list is empty only ccgName is used.
+ccgNames = []
 
 ##Do you want to enable Read-Only mode so that this script does not affect your device configurations? You will see the output on screen and receive the CSV regardless of choice.
 ##Default: 'ENABLE' does not execute Update Configurations.  'DISABLE': turns ON executing Update Configuraitons.
@@ -79,7 +114,101 @@ email_subject = 'Device Audit Mismatch Alert'
 ##example smtp_server = 'smtp.sendgrid.net'
 smtp_server = ''
 smtp_port = 587  #<-- change port as required by your SMTP server
+##Email outbox - The CSV is zipped and the finished email is queued in outboxDir (script directory) so the audit never waits on the SMTP server.
+##A separate sender process delivers the queue and retries failed emails with a growing delay.  Send the queue yourself with:  python3 XIQ-Audit-Mismatch-Alerts_v2a.py --drain-outbox
+outboxSender = 'BACKGROUND' # Default: 'BACKGROUND' starts the sender process after each run.  'EXTERNAL' only queues, e.g. when cron runs --drain-outbox.
+outboxDir = 'mail-outbox'
+outboxMaxAttempts = 10  #<-- an email that failed this many times is moved to outboxDir/failed
 ##end SMTP Settings------------------------------------------------------------------------------------------------------------------------------------
+
+##Parallel pagination - Device sweeps read page 1 to learn total_pages, then fetch the remaining pages at the same time.  CSV output is identical either way.
+parallelPagination = 'DISABLE' # Default: 'DISABLE' fetches one page at a time.  'ENABLE' to fetch pages concurrently.
+pageWorkers = 8  #<-- maximum number of pages requested at the same time when parallelPagination = 'ENABLE'
+
+##Sweep planner - Page 1 of every device sweep (plannerMaxPageSize devices, views=FULL) doubles as the probe.  A sweep that fits in page 1 ends right
+##there and with parallelPagination the remaining pages are requested at once unless the probe latency shows the sweep is short.
+sweepPlanner = 'DISABLE' # Default: 'DISABLE' pages with pageSize = 100 and learns the page count from page 1.  'ENABLE' to plan every sweep.
+plannerMaxPageSize = 100  #<-- largest page requested from /devices (XIQ accepts up to 100)
+
+##Page retries - A page request that fails with a connection error, a timeout or HTTP 408/429/500/502/503/504 is sent again after a random delay between 0 and
+##pageRetryBaseSeconds, doubling with every retry up to pageRetryMaxSeconds, instead of ending the run.  Any other error still ends the run at once.
+pageRetryMax = 4  #<-- retries per page before the script exits, 0 exits on the first failure
+pageRetryBaseSeconds = 1
+pageRetryMaxSeconds = 30
+
+##Sweep checkpoint - Every page of the Online/Offline sweeps is recorded in a checkpoint file (script directory) as soon as it is processed.  When a run
+##fails part way, the next run takes those pages from the checkpoint and only requests the pages still missing.  The checkpoint is deleted after a complete run.
+checkpointFeature = 'DISABLE' # Default: 'DISABLE' starts every sweep at page 1.  'ENABLE' to resume the sweeps of an interrupted run.
+checkpointMaxAgeMinutes = 60  #<-- an older checkpoint is discarded and the sweeps start at page 1
+
+##HTTP connection pool - Every XIQ API call shares one keep-alive session so TCP/TLS connections are reused instead of reopened per call.
+httpPoolSize = 10  #<-- connections kept open to XIQ, keep this at or above pageWorkers
+httpConnectTimeoutSeconds = 10  #<-- seconds to open a connection to XIQ before the call fails
+httpReadTimeoutSeconds = 60  #<-- seconds XIQ may stay silent while answering before the call fails (page requests are then retried, see pageRetryMax)
+
+##Asyncio run mode - Run independent audit phases concurrently.  The offline sweep runs alongside the online sweep/deployment/CCG update chain.
+asyncMode = 'DISABLE' # Default: 'DISABLE' runs each phase in sequence.  'ENABLE' to run independent phases concurrently.
+
+##Targeted CCG query - The update path queries only the CCG member device IDs (batched ID-filtered requests) instead of sweeping every online device.
+ccgTargetedQuery = 'DISABLE' # Default: 'DISABLE' finds CCG members through the full online sweep.  'ENABLE' to query CCG members directly.
+ccgQueryBatchSize = 100  #<-- device IDs per /devices request when ccgTargetedQuery = 'ENABLE'
+fullReportIntervalMinutes = 0  #<-- with ccgTargetedQuery = 'ENABLE', run the full fleet report (sweeps/CSV/email) at most this often.  0 = every run
+
+##Field projection - Device sweeps request only the fields that fill the CSV columns instead of views=FULL.  Falls back to views=FULL when XIQ does not return them.
+sweepProjection = 'DISABLE' # Default: 'DISABLE' requests views=FULL.  'ENABLE' to request only the CSV fields.
+
+##CSV report memory - Rows are streamed to disk as pages arrive and sorted by HOSTNAME with an external merge sort.  At most this many rows are held in memory.
+csvSortBufferRows = 50000
+
+##Columnar report - Also write the device records of every run to a compressed, typed Parquet or Arrow IPC file for analytics tools (requires: pip install pyarrow).
+##Each run adds one file to columnarHistoryDir, partitioned by run date, so the run history can be queried as one dataset.  The CSV and email are unchanged.
+columnarReport = 'DISABLE' # Default: 'DISABLE' writes the CSV only.  'ENABLE' to also write the columnar report.
+columnarFormat = 'parquet'  #<-- 'parquet' or 'arrow' (Arrow IPC file), both zstd compressed
+columnarHistoryDir = 'device-history'  #<-- run history folder in the script directory
+
+##Delta runs - Keep a local SQLite snapshot of the last device records.  Only devices added, removed or changed since the last run are reported,
+##and the CSV is not rewritten (nor emailed) when nothing changed.
+snapshotFeature = 'DISABLE' # Default: 'DISABLE' rewrites the full report every run.  'ENABLE' to keep a snapshot and report only changes.
+
+##Watch mode - Keep the script running and repeat the audit on an interval instead of launching it from a scheduler.  The HTTP connections,
+##access token and CCG ID stay warm between cycles and a cycle never starts while the previous one is still running.
+watchMode = 'DISABLE' # Default: 'DISABLE' runs the audit once.  'ENABLE' to repeat the audit every watchIntervalSeconds until stopped (Ctrl+C).
+watchIntervalSeconds = 60  #<-- seconds between the start of two audit cycles
+
+##Deployment chunks - Large update batches are split into chunks of device IDs that are submitted to /deployments concurrently.
+##Only the devices of a failed chunk stay in the CCG so they are retried on the next run.
+deploymentChunkSize = 100  #<-- device IDs per /deployments request
+deploymentMaxInFlight = 4  #<-- maximum number of /deployments requests sent at the same time
+
+##Rate limiting - Every XIQ API call takes a token from one shared token bucket.  A 429 response (or a 503 with Retry-After) halves the request rate,
+##waits for Retry-After and retries the call; the rate then climbs back while XIQ keeps answering, settling at the highest rate the tenant sustains.
+rateLimitFeature = 'DISABLE' # Default: 'DISABLE' sends requests as fast as the workers allow and stops on a 429.  'ENABLE' to pace and retry throttled calls.
+rateLimitMaxPerSecond = 20  #<-- starting and highest request rate
+rateLimitMinPerSecond = 1  #<-- the rate is never lowered below this
+rateLimitBurst = 10  #<-- requests that may be sent back to back while the bucket is full
+rateLimitMaxRetries = 6  #<-- times one throttled call is retried before its 429 is returned to the caller
+
+##Multi-tenant mode - Audit several XIQ organizations in one invocation.  tenantConfigFile (in the script directory) is a JSON list with one object per
+##tenant: a "name" plus the user settings that differ for that tenant, e.g. "XIQ_Token" (or "XIQ_username"/"XIQ_password") and "ccgName".  Settings a tenant
+##does not list keep the values above.  Every tenant runs in its own worker process, so tokens, sessions and caches never mix, writes "device-list-<name>.csv"
+##and "tenant-<name>.log", and one consolidated summary is written to "tenant-summary.csv".
+tenantMode = 'DISABLE' # Default: 'DISABLE' audits the tenant configured above.  'ENABLE' to audit every tenant in tenantConfigFile.
+tenantConfigFile = 'tenants.json'
+tenantWorkers = 4  #<-- maximum number of tenants audited at the same time
+
+##Run metrics - Record the wall time of every audit phase (CCG lookup, sweeps, deployments, CCG update, CSV, email), the latency of every XIQ API call
+##by endpoint, bytes received, retries and rows produced.  After each run they are written as a Prometheus textfile for the node exporter textfile
+##collector and as a JSON run summary.  The email sender adds its own "<metricsPromFile>_mail.prom" with the SMTP results.
+metricsFeature = 'DISABLE' # Default: 'DISABLE' records nothing.  'ENABLE' to write the metrics files after each run.
+metricsPromFile = 'xiq_audit.prom'  #<-- script directory, or an absolute path inside the node exporter --collector.textfile.directory
+metricsJsonFile = 'xiq-audit-metrics.json'  #<-- JSON run summary in the script directory
+
+##Profiling - Run the audit under the cProfile CPU profiler and tracemalloc allocation tracking, worker threads included.  Next to the CSV it writes
+##"device-list-profile-cpu.txt" (hottest functions), "device-list-profile-alloc.txt" (top allocation sites at the memory high point and at the end)
+##and "device-list-profile.pstats" (for pstats or snakeviz).  Profiling slows the run down while enabled; when disabled nothing is loaded or hooked.
+profileMode = 'DISABLE' # Default: 'DISABLE'.  'ENABLE' to profile the run.
+profileTopFunctions = 40  #<-- functions listed per sort order in the CPU report
+profileTopAllocations = 25  #<-- allocation sites listed per snapshot in the allocation report
 #endregion
 
 #region #************************* No user edits below this line required ************************************************************************************
@@ -88,6 +217,26 @@ URL = "https://api.extremecloudiq.com"  ##XIQ's API portal
 headers = {"Accept": "application/json", "Content-Type": "application/json"}
 PATH = os.path.dirname(os.path.abspath(__file__))  #Stores the current Python script directory to write the CSV file to
 filename = 'device-list.csv' #<- file name that will be created in the current directory of the Python file
+fullReportStampFile = '.xiq-full-report'  #<- records when the last full fleet report ran (fullReportIntervalMinutes)
+snapshotFile = 'device-snapshot.db'  #<- SQLite snapshot of the last device records (snapshotFeature), stored in the script directory
+tokenCacheFile = '.xiq-token-cache.json'  #<- access token and expiry (tokenCacheFeature), stored in the script directory with owner-only permissions
+changesFilename = 'device-list-changes.csv'  #<- devices added, removed or changed since the last run (snapshotFeature)
+tenantSummaryFile = 'tenant-summary.csv'  #<- one line per tenant audited by tenantMode
+ccgCacheFile = '.xiq-ccg-cache.json'  #<- CCG name to ID found by the last CCG search, stored in the script directory
+checkpointFile = '.xiq-sweep-checkpoint.jsonl'  #<- sweep pages of an unfinished run (checkpointFeature), stored in the script directory
+outboxChunkBytes = 57 * 1024  #Bytes of the zipped CSV base64 encoded at a time into a queued email (a multiple of 57 keeps every line 76 characters)
+outboxClaimSeconds = 3600  #A queued email claimed by a sender for longer than this is treated as abandoned and queued again
+tenantName = ''  #Tenant audited by this tenantMode worker process, '' outside multi-tenant mode
+metricsLatencyBuckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  #Upper bounds in seconds of the per endpoint request latency histograms (metricsFeature)
+pageSize = 100  #Number of records requested per page from XIQ
+pageRetryStatusCodes = (408, 429, 500, 502, 503, 504)  #HTTP status codes of a page request that are retried (pageRetryMax)
+plannerSerialSeconds = 0.5  #A planned sweep estimated (pages x probe latency) to take less than this is fetched one page at a time, worker threads would not pay off
+columnarBatchRows = 10000  #Device records per Parquet row group / Arrow record batch (columnarReport)
+projectionProbeSize = 10  #Devices requested by the projected/FULL probes used to check the projection and estimate bytes saved
+onlineSweepFields = ['id', 'hostname', 'device_function', 'locations', 'software_version', 'ip_address', 'network_policy_name', 'product_type']
+offlineSweepFields = onlineSweepFields + ['last_connect_time']
+projectionStats = {'devices': 0, 'bytesSaved': 0, 'fallbacks': []}  #Field projection results for the current run (sweepProjection)
+projectionStatsLock = threading.Lock()
 colorWhite = fg(255) ##DEFAULT Color: color pallete here: https://dslackw.gitlab.io/colored/tables/colors/
 colorRed = fg(1) ##RED
 colorGreen = fg(2) ##GREEN
@@ -95,15 +244,842 @@ colorPurple = fg(54) ##PURPLE
 colorCyan = fg(6) ##CYAN
 colorOrange = fg(94) ##ORANGE
 colorGrey = fg(8)  ##GREY
-ccgMembersIDs = []  #Stores a list of device IDs that are a member of the CCG (ccgName)
 ccgSimMemberID = []  #Stores the SIM device ID so it can be ommitted from being removed from the CCG (ccgName)
+xiqSession = None  #Shared requests.Session used by every XIQ API call, created on first use by GetXiqSession()
+xiqSessionLock = threading.Lock()
+tokenExpiresAt = 0  #Epoch time the access token from /login expires, 0 when a static XIQ_Token is used
+tokenLock = threading.Lock()
+ccgFlagTuples = {}  #Every distinct per-CCG Yes/No tuple once, shared by all DeviceRecords that have it
+ccgIdCache = {}  #CCG name to ID resolved by LocateCcgGroups, loaded from and saved to ccgCacheFile
+rateLimiter = None  #Shared RateLimiter (rateLimitFeature), created on first use by GetRateLimiter() and kept across watch mode cycles
+rateLimiterLock = threading.Lock()
+runMetrics = None  #RunMetrics of the audit cycle in progress (metricsFeature), None when metrics are off
+activeProfile = None  #ProfileSession of the run in progress (profileMode), None when not profiling
+credentialsPrompted = False  #True when the XIQ username/password were typed at the prompt (authentication option 2)
+sweepCheckpoint = None  #SweepCheckpoint of the audit cycle in progress (checkpointFeature), None when off
 #endregion #end Global Variables---------------------------------------------------------------------------------------------------------------------------------
 
+##Membership index of the CCG device IDs shared by the CCG lookup, both sweeps and UpdateCCG----------------------------------------
+##Lookups are constant time, removals are a set difference and the original XIQ order is kept for the CCG PUT payload
+class CcgMemberIndex:
+    def __init__(self, deviceIds=()):
+        self.members = dict.fromkeys(deviceIds)  #dict keys keep insertion order and hash lookups
+
+    def __contains__(self, deviceId):
+        return deviceId in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def RemoveIds(self, deviceIds):
+        for deviceId in set(deviceIds):
+            self.members.pop(deviceId, None)
+
+    def Copy(self):
+        return CcgMemberIndex(self.members)
+
+    def ToList(self):
+        return list(self.members)
+
+##One update CCG:  its name, XIQ ID and member index
+class CcgGroup:
+    def __init__(self, name, ccgID, deviceIds=()):
+        self.name = name
+        self.ccgID = ccgID
+        self.members = CcgMemberIndex(deviceIds)
+
+    def Copy(self):
+        return CcgGroup(self.name, self.ccgID, self.members)
+
+##Names of the update CCGs in the order of their CSV columns
+def UpdateCcgNames():
+    return list(dict.fromkeys(ccgNames)) if ccgNames else [ccgName]
+
+def CcgLabel(names):
+    return '"' + '", "'.join(names) + '" CCG' + ('s' if len(names) > 1 else '')
+##end Membership index of the CCG device IDs--------------------------------------------------------------------------------------
+
+##Compact device record produced by the sweeps and consumed by the CSV writer and the snapshot------------------------------------
+##One slotted object per device instead of a 14 key dict.  NormalizeDevicePage shares the CCG Yes/No tuples and interns the
+##low-cardinality text values (type, building, floor, software, policy, model), so repeated values are stored once for the fleet.
+class DeviceRecord:
+    __slots__ = ('hostname', 'deviceType', 'status', 'auditFlag', 'building', 'floor', 'ccgFlags', 'updated',
+                 'software', 'ip', 'policy', 'model', 'lastSeen', 'deviceId')
+
+    def __init__(self, hostname, deviceType, status, auditFlag, building, floor, ccgFlags, updated, software, ip, policy, model, lastSeen, deviceId):
+        self.hostname = hostname
+        self.deviceType = deviceType
+        self.status = status
+        self.auditFlag = auditFlag
+        self.building = building
+        self.floor = floor
+        self.ccgFlags = ccgFlags
+        self.updated = updated
+        self.software = software
+        self.ip = ip
+        self.policy = policy
+        self.model = model
+        self.lastSeen = lastSeen
+        self.deviceId = deviceId  #not a CSV column, keys the snapshot
+
+    ##CSV values in ReportColumns() order
+    def Values(self):
+        return ([self.hostname, self.deviceType, self.status, self.auditFlag, self.building, self.floor] + list(self.ccgFlags) +
+                [self.updated, self.software, self.ip, self.policy, self.model, self.lastSeen])
+
+    def SortKey(self):
+        return (self.hostname is None, self.hostname or '')
+
+    ##Values kept by the sweep checkpoint:  the device fields only, the CCG columns are worked out again by the run that restores them
+    def CheckpointValues(self):
+        return [self.hostname, self.deviceType, self.building, self.floor, self.software, self.ip, self.policy, self.model, self.lastSeen, self.deviceId]
+
+##end Compact device record-----------------------------------------------------------------------------------------------------
+
+##Shared device normalizer used by every sweep------------------------------------------------------------------------------------
+##Turns the data array of one /devices page into DeviceRecords column by column:  each report column is built for the whole page
+##with one comprehension and the records are assembled from the columns.  Every optional field falls back the same way, so a key
+##missing from the response (XIQ-Site Engine devices, field projection) gives 'Unknown' instead of an error in any sweep.
+def NormalizeDevicePage(devices, status, auditFlag, ccgGroups, updatedInCcg, updatedNotInCcg, lastSeen=None):
+    deviceIds = [device.get('id') for device in devices]
+    locations = [device.get('locations') for device in devices]
+    ccgFlags,updatedColumn = CcgFlagColumns(deviceIds, ccgGroups, updatedInCcg, updatedNotInCcg)
+    if lastSeen is None:
+        lastSeenColumn = DeviceColumn(devices, 'last_connect_time', 'Check if device has ever connected to XIQ')
+    else:
+        lastSeenColumn = repeat(lastSeen)
+    return list(map(DeviceRecord,
+                    [device.get('hostname') for device in devices],
+                    InternColumn(DeviceColumn(devices, 'device_function', 'Unknown')),
+                    repeat(status),
+                    repeat(auditFlag),
+                    InternColumn([entries[-2]['name'] if entries else 'No Location' for entries in locations]),
+                    InternColumn([entries[-1]['name'] if entries else 'No Floor' for entries in locations]),
+                    ccgFlags,
+                    updatedColumn,
+                    InternColumn(DeviceColumn(devices, 'software_version', 'Unknown')),
+                    DeviceColumn(devices, 'ip_address', 'Unknown'),
+                    InternColumn(DeviceColumn(devices, 'network_policy_name', 'Unknown')),
+                    InternColumn(DeviceColumn(devices, 'product_type', 'Unknown')),
+                    lastSeenColumn,
+                    deviceIds))
+
+##DeviceRecords of a page restored from the sweep checkpoint (DeviceRecord.CheckpointValues() rows).  The CCG and UPDATED columns
+##come from the CCGs of this run, so a device deployed and removed from its CCG before the interruption is not deployed again.
+def RestoreDevicePage(rows, status, auditFlag, ccgGroups, updatedInCcg, updatedNotInCcg):
+    hostnames,deviceTypes,buildings,floors,software,ips,policies,models,lastSeen,deviceIds = zip(*rows) if rows else [()] * 10
+    ccgFlags,updatedColumn = CcgFlagColumns(deviceIds, ccgGroups, updatedInCcg, updatedNotInCcg)
+    return list(map(DeviceRecord, hostnames, InternColumn(deviceTypes), repeat(status), repeat(auditFlag), InternColumn(buildings),
+                    InternColumn(floors), ccgFlags, updatedColumn, InternColumn(software), ips, InternColumn(policies), InternColumn(models),
+                    lastSeen, deviceIds))
+
+##CCG Yes/No tuple (shared through ccgFlagTuples) and UPDATED value of every device ID of a page
+def CcgFlagColumns(deviceIds, ccgGroups, updatedInCcg, updatedNotInCcg):
+    memberColumns = [['Yes' if deviceId in group.members else 'No' for deviceId in deviceIds] for group in ccgGroups]
+    ccgFlags = [ccgFlagTuples.setdefault(flags, flags) for flags in zip(*memberColumns)]
+    return ccgFlags,[updatedInCcg if 'Yes' in flags else updatedNotInCcg for flags in ccgFlags]
+
+##One report column for a page:  the field of every device, or the default when it is missing or empty
+def DeviceColumn(devices, key, default):
+    return [device.get(key) or default for device in devices]
+
+##Low-cardinality column with every repeated text value stored once
+def InternColumn(values):
+    intern = sys.intern
+    return [intern(value) if type(value) is str else value for value in values]
+##end Shared device normalizer----------------------------------------------------------------------------------------------------
+
+##Streaming CSV report writer---------------------------------------------------------------------------------------------------
+##DeviceRecords are added as pages arrive.  Once csvSortBufferRows records are buffered they are sorted by HOSTNAME and spilled to a
+##temporary run file; Close() merges the runs into the CSV so memory stays bounded no matter how large the fleet is.
+def ReportColumns():
+    return (['HOSTNAME', 'TYPE', 'STATUS', 'AUDIT FLAG', 'BUILDING', 'FLOOR'] + ['CCG-' + name for name in UpdateCcgNames()] +
+            ['UPDATED', 'SOFTWARE', 'IP', 'POLICY', 'MODEL', 'LAST SEEN'])
+
+def HostnameSortKey(values):
+    return (values[0] is None, values[0] or '')  #missing hostnames sort last, like pandas sort_values
+
+class ReportWriter:
+    def __init__(self, reportFile, columns, bufferRows=None):
+        self.reportFile = reportFile
+        self.columns = columns
+        self.bufferRows = max(1, bufferRows or csvSortBufferRows)
+        self.buffer = []
+        self.runFiles = []
+        self.runDir = None
+        self.rowCount = 0
+        self.lock = threading.Lock()  #both sweeps add rows at the same time in asyncMode
+
+    def AddRows(self, rows):
+        with self.lock:
+            self.buffer.extend(rows)
+            self.rowCount += len(rows)
+            if len(self.buffer) >= self.bufferRows:
+                self.SpillBuffer()
+
+    def SpillBuffer(self):
+        if self.runDir is None:
+            import tempfile
+            self.runDir = tempfile.mkdtemp(prefix='xiq-report-')
+        self.buffer.sort(key=DeviceRecord.SortKey)
+        runFile = os.path.join(self.runDir, f'run-{len(self.runFiles):05d}.jsonl')
+        with open(runFile, 'w') as runOut:
+            for record in self.buffer:
+                runOut.write(json.dumps(record.Values()) + '\n')  #JSON keeps None apart from '' for the merge key
+        self.runFiles.append(runFile)
+        self.buffer = []
+
+    def ReadRun(self, runFile):
+        with open(runFile) as runIn:
+            for line in runIn:
+                yield json.loads(line)
+
+    def Close(self):
+        with self.lock:
+            try:
+                if self.runFiles:
+                    if self.buffer:
+                        self.SpillBuffer()
+                    sortedRows = heapq.merge(*(self.ReadRun(runFile) for runFile in self.runFiles), key=HostnameSortKey)
+                else:
+                    self.buffer.sort(key=DeviceRecord.SortKey)
+                    sortedRows = (record.Values() for record in self.buffer)
+                with open(self.reportFile, 'w', newline='') as reportOut:
+                    writer = csv.writer(reportOut, lineterminator=os.linesep)
+                    writer.writerow(self.columns)
+                    writer.writerows(sortedRows)
+            finally:
+                self.Discard()
+
+    def Discard(self):
+        self.buffer = []
+        for runFile in self.runFiles:
+            try:
+                os.remove(runFile)
+            except OSError:
+                pass
+        if self.runDir is not None:
+            try:
+                os.rmdir(self.runDir)
+            except OSError:
+                pass
+        self.runFiles = []
+        self.runDir = None
+##Sends each page of DeviceRecords to every sink: the CSV writer, the snapshot, ...
+class ReportSinks:
+    def __init__(self, sinks):
+        self.sinks = [sink for sink in sinks if sink is not None]
+
+    def AddRows(self, rows):
+        for sink in self.sinks:
+            sink.AddRows(rows)
+##end Streaming CSV report writer-----------------------------------------------------------------------------------------------
+
+##SQLite snapshot of the last normalized device records (snapshotFeature)-------------------------------------------------------
+##Rows of this run go to a temporary table as pages arrive.  Diff() compares it with the stored snapshot and Commit() writes back
+##only the added, removed and changed devices, so the work after the sweeps grows with the number of changes, not the fleet.
+class DeviceSnapshot:
+    def __init__(self, snapshotPath, columns):
+        import sqlite3
+        self.columns = columns
+        self.lock = threading.Lock()  #both sweeps add rows at the same time in asyncMode
+        self.connection = sqlite3.connect(snapshotPath, check_same_thread=False)
+        with self.lock:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS devices (device_id INTEGER PRIMARY KEY, record TEXT NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.connection.execute("CREATE TEMP TABLE current (device_id INTEGER PRIMARY KEY, record TEXT NOT NULL)")
+            storedColumns = self.connection.execute("SELECT value FROM meta WHERE key = 'columns'").fetchone()
+            self.hasBaseline = storedColumns is not None and json.loads(storedColumns[0]) == columns  #a new CCG column starts a new baseline
+
+    def AddRows(self, rows):
+        records = [(row.deviceId, json.dumps(row.Values())) for row in rows]
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO current VALUES (?, ?)", records)
+
+    ##Returns {'added': [...], 'removed': [...], 'changed': [...]}, each a list of CSV value lists sorted by hostname
+    def Diff(self):
+        queries = {
+            'added': "SELECT c.record FROM current c LEFT JOIN devices d ON d.device_id = c.device_id WHERE d.device_id IS NULL",
+            'removed': "SELECT d.record FROM devices d LEFT JOIN current c ON c.device_id = d.device_id WHERE c.device_id IS NULL",
+            'changed': "SELECT c.record FROM current c JOIN devices d ON d.device_id = c.device_id WHERE d.record != c.record"}
+        delta = {}
+        with self.lock:
+            for change, query in queries.items():
+                if not self.hasBaseline and change != 'added':
+                    delta[change] = []
+                    continue
+                if not self.hasBaseline:
+                    query = "SELECT record FROM current"
+                delta[change] = sorted((json.loads(record) for (record,) in self.connection.execute(query)), key=HostnameSortKey)
+        return delta
+
+    def Commit(self):
+        with self.lock:
+            if not self.hasBaseline:
+                self.connection.execute("DELETE FROM devices")
+            self.connection.execute("DELETE FROM devices WHERE device_id NOT IN (SELECT device_id FROM current)")
+            self.connection.execute("INSERT OR REPLACE INTO devices SELECT c.device_id, c.record FROM current c "
+                                    "LEFT JOIN devices d ON d.device_id = c.device_id WHERE d.device_id IS NULL OR d.record != c.record")
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('columns', ?)", (json.dumps(self.columns),))
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('updated', ?)", (str(time.time()),))
+            self.connection.commit()
+            self.hasBaseline = True
+
+    def Close(self):
+        with self.lock:
+            self.connection.close()
+
+##Print the delta and write it to changesFilename.  Returns the summary lines used in the email.
+def WriteDeltaReport(delta, columns):
+    summary = [f"Changes since last run: {len(delta['added'])} added, {len(delta['removed'])} removed, {len(delta['changed'])} changed"]
+    for change in ('added', 'removed', 'changed'):
+        if delta[change]:
+            summary.append(change.capitalize() + ': ' + ', '.join(str(values[0]) for values in delta[change]))
+    print(f'\n{colorCyan}' + '\n'.join(summary))
+    with open(changesFilename, 'w', newline='') as changesOut:
+        writer = csv.writer(changesOut, lineterminator=os.linesep)
+        writer.writerow(['CHANGE'] + columns)
+        for change in ('added', 'removed', 'changed'):
+            writer.writerows([change.upper()] + values for values in delta[change])
+    return summary
+##end SQLite snapshot of the last normalized device records----------------------------------------------------------------------
+
+##Typed columnar report of the device records (columnarReport)--------------------------------------------------------------------
+##Receives the same DeviceRecords as the CSV writer and streams them in batches of columnarBatchRows to a Parquet or Arrow IPC file under
+##columnarHistoryDir/run_date=YYYY-MM-DD/, so memory stays bounded.  CCG membership is boolean, LAST CONNECT is a UTC timestamp parsed
+##from LAST SEEN and every row carries the RUN TIME.  The file is written under a temporary name and only renamed by Close().
+class ColumnarReportWriter:
+    def __init__(self, ccgNamesLocal):
+        import pyarrow
+        self.pyarrow = pyarrow
+        self.ccgNames = ccgNamesLocal
+        self.runTime = time.time()
+        self.schema = pyarrow.schema(
+            [('RUN TIME', pyarrow.timestamp('ms', tz='UTC')), ('DEVICE ID', pyarrow.int64()), ('HOSTNAME', pyarrow.string()),
+             ('TYPE', pyarrow.string()), ('STATUS', pyarrow.string()), ('AUDIT FLAG', pyarrow.string()), ('BUILDING', pyarrow.string()),
+             ('FLOOR', pyarrow.string())] +
+            [('CCG-' + name, pyarrow.bool_()) for name in ccgNamesLocal] +
+            [('UPDATED', pyarrow.string()), ('SOFTWARE', pyarrow.string()), ('IP', pyarrow.string()), ('POLICY', pyarrow.string()),
+             ('MODEL', pyarrow.string()), ('LAST SEEN', pyarrow.string()), ('LAST CONNECT', pyarrow.timestamp('ms', tz='UTC'))])
+        runDir = os.path.join(PATH, columnarHistoryDir, 'run_date=' + time.strftime('%Y-%m-%d', time.gmtime(self.runTime)))
+        os.makedirs(runDir, exist_ok=True)
+        extension = 'arrow' if columnarFormat == 'arrow' else 'parquet'
+        self.reportFile = os.path.join(runDir, 'devices-' + time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(self.runTime)) + '.' + extension)
+        self.tempFile = self.reportFile + '.tmp'
+        if columnarFormat == 'arrow':
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(self.tempFile, self.schema, options=pyarrow.ipc.IpcWriteOptions(compression='zstd'))
+        else:
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(self.tempFile, self.schema, compression='zstd')
+        self.buffer = []
+        self.rowCount = 0
+        self.connectTimes = {}  #LAST SEEN text to epoch milliseconds, most devices share a handful of values
+        self.lock = threading.Lock()  #both sweeps add rows at the same time in asyncMode
+
+    def AddRows(self, rows):
+        with self.lock:
+            self.buffer.extend(rows)
+            if len(self.buffer) >= columnarBatchRows:
+                self.WriteBatch()
+
+    def WriteBatch(self):
+        if not self.buffer:
+            return
+        pyarrow = self.pyarrow
+        records = self.buffer
+        self.buffer = []
+        columns = ([[int(self.runTime * 1000)] * len(records), [record.deviceId for record in records], [record.hostname for record in records],
+                    [record.deviceType for record in records], [record.status for record in records], [record.auditFlag for record in records],
+                    [record.building for record in records], [record.floor for record in records]] +
+                   [[record.ccgFlags[index] == 'Yes' for record in records] for index in range(len(self.ccgNames))] +
+                   [[record.updated for record in records], [record.software for record in records], [record.ip for record in records],
+                    [record.policy for record in records], [record.model for record in records], [record.lastSeen for record in records],
+                    [self.ConnectTime(record.lastSeen) for record in records]])
+        arrays = [pyarrow.array(values, type=field.type) for values, field in zip(columns, self.schema)]
+        self.writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.rowCount += len(records)
+
+    ##Epoch milliseconds of an XIQ time such as 2024-06-11T19:42:16.000+0000, None for 'Now' and other text
+    def ConnectTime(self, lastSeen):
+        if lastSeen not in self.connectTimes:
+            import datetime
+            try:
+                self.connectTimes[lastSeen] = int(datetime.datetime.strptime(lastSeen, '%Y-%m-%dT%H:%M:%S.%f%z').timestamp() * 1000)
+            except (TypeError, ValueError):
+                self.connectTimes[lastSeen] = None
+        return self.connectTimes[lastSeen]
+
+    def Close(self):
+        with self.lock:
+            self.WriteBatch()
+            self.writer.close()
+            self.writer = None
+            os.replace(self.tempFile, self.reportFile)
+        print(f'{colorPurple}Columnar report with {self.rowCount} devices written to "' + os.path.relpath(self.reportFile, PATH) + '"\n')
+
+    def Discard(self):
+        with self.lock:
+            self.buffer = []
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            try:
+                os.remove(self.tempFile)
+            except OSError:
+                pass
+
+##The columnar writer for this run, None when columnarReport is off or pyarrow is missing (the CSV is still written)
+def CreateColumnarWriter():
+    if columnarReport != 'ENABLE':
+        return None
+    try:
+        return ColumnarReportWriter(UpdateCcgNames())
+    except ImportError:
+        print(f'{colorRed}columnarReport needs pyarrow (pip install pyarrow), writing the CSV report only.\n')
+        return None
+##end Typed columnar report of the device records---------------------------------------------------------------------------------
+
+##Run metrics (metricsFeature)-------------------------------------------------------------------------------------------------------
+##Collected by the audit cycle in progress from the worker threads of the sweeps and deployments:  phase wall times, one latency
+##histogram per endpoint, response bytes and status codes, retries and rows.  Phases that overlap (asyncMode) each keep their own wall time.
+class RunMetrics:
+    def __init__(self):
+        self.startTime = time.time()
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.endpoints = {}
+        self.retries = {}
+        self.rows = {}
+
+    ##A phase that runs more than once in a cycle (e.g. one deployment per CCG) adds up
+    def AddPhase(self, phaseName, seconds):
+        with self.lock:
+            self.phases[phaseName] = self.phases.get(phaseName, 0.0) + seconds
+
+    def AddRequest(self, method, url, statusCode, seconds, responseBytes):
+        endpoint = (method, EndpointLabel(url))
+        bucket = next((index for index, bound in enumerate(metricsLatencyBuckets) if seconds <= bound), len(metricsLatencyBuckets))
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {'count': 0, 'seconds': 0.0, 'maxSeconds': 0.0, 'bytes': 0, 'buckets': [0] * (len(metricsLatencyBuckets) + 1), 'codes': {}}
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['maxSeconds'] = max(stats['maxSeconds'], seconds)
+            stats['bytes'] += responseBytes
+            stats['buckets'][bucket] += 1
+            stats['codes'][str(statusCode)] = stats['codes'].get(str(statusCode), 0) + 1
+
+    def AddRetry(self, reason):
+        with self.lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+
+    def AddRows(self, kind, count):
+        with self.lock:
+            self.rows[kind] = self.rows.get(kind, 0) + count
+
+    ##JSON run summary, also the source of the Prometheus textfile
+    def Summary(self, status):
+        with self.lock:
+            endpointStats = {}
+            for (method, endpoint), stats in sorted(self.endpoints.items(), key=lambda item: (item[0][1], item[0][0])):
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(list(metricsLatencyBuckets) + ['+Inf'], stats['buckets']):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                endpointStats[f'{method} {endpoint}'] = {'method': method, 'endpoint': endpoint, 'count': stats['count'], 'bytes': stats['bytes'],
+                                                         'seconds': round(stats['seconds'], 4), 'max_seconds': round(stats['maxSeconds'], 4),
+                                                         'status_codes': dict(stats['codes']), 'latency_buckets': buckets}
+            return {'tenant': tenantName, 'status': status, 'start_time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.startTime)),
+                    'duration_seconds': round(time.perf_counter() - self.started, 4),
+                    'phases': {phaseName: round(seconds, 4) for phaseName, seconds in self.phases.items()},
+                    'requests': endpointStats, 'bytes_received': sum(stats['bytes'] for stats in self.endpoints.values()),
+                    'retries': dict(self.retries), 'rows': dict(self.rows), 'http_pool': GetPoolStats()}
+
+##Endpoint of an XIQ API URL without the query string, numeric IDs become {id} so /ccgs/1234 and /ccgs/5678 share one histogram
+def EndpointLabel(url):
+    path = url.split('?', 1)[0]
+    if path.startswith(URL):
+        path = path[len(URL):]
+    return '/'.join('{id}' if part.isdigit() else part for part in path.split('/')) or '/'
+
+##Times the block as one audit phase of runMetrics, does nothing when metrics are off
+class MetricsPhase:
+    def __init__(self, phaseName):
+        self.phaseName = phaseName
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *excInfo):
+        if runMetrics is not None:
+            runMetrics.AddPhase(self.phaseName, time.perf_counter() - self.started)
+
+##Decorator form of MetricsPhase for the functions that make up one phase
+def TimedPhase(phaseName):
+    def Decorate(function):
+        def Timed(*args, **kwargs):
+            with MetricsPhase(phaseName):
+                return function(*args, **kwargs)
+        Timed.__name__ = function.__name__
+        Timed.__doc__ = function.__doc__
+        return Timed
+    return Decorate
+
+def CountMetric(kind, count=1, retry=False):
+    if runMetrics is not None:
+        if retry:
+            runMetrics.AddRetry(kind)
+        else:
+            runMetrics.AddRows(kind, count)
+
+def MetricsPath(metricsFile):
+    return os.path.join(PATH, metricsFile)  #an absolute metricsFile stays as is
+
+##Prometheus label value with \ " and newlines escaped
+def PromLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+##Prometheus text exposition lines for one metric:  samples are (name suffix, labels, value)
+def PromMetric(name, metricType, helpText, samples):
+    lines = [f'# HELP {name} {helpText}', f'# TYPE {name} {metricType}']
+    baseLabels = {'tenant': tenantName} if tenantName else {}
+    for suffix, labels, value in samples:
+        labels = {**baseLabels, **labels}
+        labelText = '{' + ','.join(f'{key}="{PromLabel(labelValue)}"' for key, labelValue in labels.items()) + '}' if labels else ''
+        lines.append(f'{name}{suffix}{labelText} {value}')
+    return lines
+
+##Write a metrics file through a temporary file and a rename so the node exporter never reads a half written file
+def WriteMetricsFile(metricsFile, text):
+    metricsPath = MetricsPath(metricsFile)
+    try:
+        with open(metricsPath + '.tmp', 'w') as metricsOut:
+            metricsOut.write(text)
+        os.replace(metricsPath + '.tmp', metricsPath)
+    except OSError as e:
+        print(f'{colorOrange}Unable to write the metrics file "{metricsFile}": {e}')
+
+##Write the Prometheus textfile and the JSON run summary of the finished audit cycle
+def WriteRunMetrics(metrics, status):
+    summary = metrics.Summary(status)
+    lines = []
+    lines += PromMetric('xiq_audit_last_run_timestamp_seconds', 'gauge', 'Start time of the last audit run.', [('', {}, round(metrics.startTime, 3))])
+    lines += PromMetric('xiq_audit_last_run_success', 'gauge', '1 when the last audit run completed, 0 when it failed.', [('', {}, int(status == 'ok'))])
+    lines += PromMetric('xiq_audit_run_duration_seconds', 'gauge', 'Wall time of the last audit run.', [('', {}, summary['duration_seconds'])])
+    lines += PromMetric('xiq_audit_phase_duration_seconds', 'gauge', 'Wall time of each phase of the last audit run.',
+                        [('', {'phase': phaseName}, seconds) for phaseName, seconds in summary['phases'].items()])
+    histogramSamples = []
+    for stats in summary['requests'].values():
+        endpointLabels = {'method': stats['method'], 'endpoint': stats['endpoint']}
+        histogramSamples += [('_bucket', {**endpointLabels, 'le': bound}, count) for bound, count in stats['latency_buckets'].items()]
+        histogramSamples += [('_sum', endpointLabels, stats['seconds']), ('_count', endpointLabels, stats['count'])]
+    lines += PromMetric('xiq_audit_request_duration_seconds', 'histogram', 'XIQ API request latency of the last audit run by endpoint.', histogramSamples)
+    lines += PromMetric('xiq_audit_response_bytes', 'gauge', 'Response body bytes received from XIQ in the last audit run by endpoint.',
+                        [('', {'method': stats['method'], 'endpoint': stats['endpoint']}, stats['bytes']) for stats in summary['requests'].values()])
+    lines += PromMetric('xiq_audit_responses', 'gauge', 'XIQ API responses of the last audit run by endpoint and status code.',
+                        [('', {'method': stats['method'], 'endpoint': stats['endpoint'], 'code': code}, count)
+                         for stats in summary['requests'].values() for code, count in stats['status_codes'].items()])
+    lines += PromMetric('xiq_audit_retries', 'gauge', 'XIQ API calls retried in the last audit run by reason.',
+                        [('', {'reason': reason}, count) for reason, count in summary['retries'].items()])
+    lines += PromMetric('xiq_audit_rows', 'gauge', 'Devices produced by the last audit run by kind.',
+                        [('', {'kind': kind}, count) for kind, count in summary['rows'].items()])
+    WriteMetricsFile(metricsPromFile, '\n'.join(lines) + '\n')
+    WriteMetricsFile(metricsJsonFile, json.dumps(summary, indent=2) + '\n')
+    phaseText = ', '.join(f'{phaseName} {seconds:.2f} s' for phaseName, seconds in summary['phases'].items())
+    print(f"{colorWhite}Run metrics: {summary['duration_seconds']:.2f} s ({phaseText}), {sum(stats['count'] for stats in summary['requests'].values())} requests, "
+          f"{summary['bytes_received'] / 1024:,.0f} KB received.  Written to \"{metricsPromFile}\" and \"{metricsJsonFile}\"\n")
+
+##Prometheus textfile of the email sender, next to metricsPromFile, written after every pass over the outbox
+def WriteMailMetrics(sent, failed, waiting, seconds):
+    promRoot,promExtension = os.path.splitext(metricsPromFile)
+    lines = []
+    lines += PromMetric('xiq_audit_mail_last_drain_timestamp_seconds', 'gauge', 'Time the email outbox was last sent.', [('', {}, round(time.time(), 3))])
+    lines += PromMetric('xiq_audit_mail_last_drain_duration_seconds', 'gauge', 'Wall time of the last pass over the email outbox, SMTP included.', [('', {}, round(seconds, 4))])
+    lines += PromMetric('xiq_audit_mail_last_drain_emails', 'gauge', 'Emails of the last pass over the email outbox by result.',
+                        [('', {'result': 'sent'}, sent), ('', {'result': 'failed'}, failed), ('', {'result': 'waiting'}, waiting)])
+    WriteMetricsFile(f'{promRoot}_mail{promExtension}', '\n'.join(lines) + '\n')
+##end Run metrics------------------------------------------------------------------------------------------------------------------
+
+##Profiling (profileMode)----------------------------------------------------------------------------------------------------------
+##One run under cProfile and tracemalloc.  Before Python 3.12 a cProfile profiler only sees the thread that enabled it, so every thread
+##started during the run (page workers, deployment chunks, asyncio phases) gets its own profiler and the results are merged; from 3.12
+##one profiler sees every thread.  The allocation report shows the snapshot taken at the highest traced memory and one at the end.
+class ProfileSession:
+    def __init__(self, reportPrefix):
+        import cProfile
+        import tracemalloc
+        self.reportPrefix = reportPrefix
+        self.threadProfiles = []
+        self.lock = threading.Lock()
+        self.peakSnapshot = None
+        self.started = time.perf_counter()
+        tracemalloc.start()
+        self.profile = cProfile.Profile()
+        if sys.version_info < (3, 12):
+            threading.setprofile(self.StartThreadProfile)
+        self.profile.enable()
+
+    ##Installed with threading.setprofile, runs once as the first profile event of every new thread
+    def StartThreadProfile(self, frame, event, arg):
+        import cProfile
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.threadProfiles.append(profile)
+        profile.enable()
+
+    ##Snapshot the live allocations, kept when more memory is traced than at the previous high point.  The CPU profiler of the calling
+    ##thread is paused so the snapshot does not show up in the CPU report.
+    def Snapshot(self, label):
+        import tracemalloc
+        traced = tracemalloc.get_traced_memory()[0]
+        if self.peakSnapshot is None or traced > self.peakSnapshot[2]:
+            self.profile.disable()
+            self.peakSnapshot = (label, tracemalloc.take_snapshot(), traced)
+            self.profile.enable()
+
+    ##Stop profiling and write the CPU and allocation reports
+    def Stop(self):
+        import linecache
+        import pstats
+        import tracemalloc
+        self.profile.disable()
+        threading.setprofile(None)
+        wallTime = time.perf_counter() - self.started
+        endSnapshot = ('the end of the run', tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()[0])
+        peakTraced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stats = pstats.Stats(self.profile)
+        with self.lock:
+            for profile in self.threadProfiles:
+                stats.add(profile)
+        cpuFile = self.reportPrefix + '-profile-cpu.txt'
+        stats.dump_stats(self.reportPrefix + '-profile.pstats')
+        with open(cpuFile, 'w') as cpuReport:
+            cpuReport.write(f'CPU profile of {os.path.basename(__file__)}, {time.strftime("%Y-%m-%d %H:%M:%S")}:  {wallTime:.2f} s wall time, '
+                            f'{len(self.threadProfiles) + 1} thread(s) profiled\n')
+            stats.stream = cpuReport
+            for sortKey, title in (('cumulative', 'time spent in the function and everything it calls'), ('tottime', 'time spent in the function itself')):
+                cpuReport.write(f'\n========== Top {profileTopFunctions} functions by {sortKey}: {title} ==========\n')
+                stats.sort_stats(sortKey).print_stats(profileTopFunctions)
+        allocFile = self.reportPrefix + '-profile-alloc.txt'
+        with open(allocFile, 'w') as allocReport:
+            allocReport.write(f'Allocation profile of {os.path.basename(__file__)}, {time.strftime("%Y-%m-%d %H:%M:%S")}:  peak traced memory '
+                              f'{peakTraced / 1048576:.1f} MB (tracemalloc adds its own overhead to the process memory)\n')
+            ignoredFiles = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib*'), tracemalloc.Filter(False, '<unknown>')]
+            for label, snapshot, traced in [self.peakSnapshot, endSnapshot] if self.peakSnapshot is not None else [endSnapshot]:
+                allocReport.write(f'\n========== Top {profileTopAllocations} allocation sites live at {label} ({traced / 1048576:.1f} MB traced) ==========\n')
+                for rank, stat in enumerate(snapshot.filter_traces(ignoredFiles).statistics('lineno')[:profileTopAllocations], start=1):
+                    frame = stat.traceback[0]
+                    allocReport.write(f'{rank:>3}. {frame.filename}:{frame.lineno}  {stat.size / 1024:,.1f} KiB in {stat.count} blocks\n'
+                                      f'       {linecache.getline(frame.filename, frame.lineno).strip()}\n')
+        print(f'{colorWhite}Profile: {wallTime:.2f} s, peak traced memory {peakTraced / 1048576:.1f} MB.  Reports written to "{cpuFile}" and "{allocFile}"\n')
+
+##Start profiling the run when profileMode is enabled; reports are named after the CSV so they land next to it
+def StartProfiling():
+    global activeProfile
+    if profileMode == 'ENABLE' and activeProfile is None:
+        print(f'{colorOrange}Profiling mode is enabled, the run is slower than usual.\n')
+        activeProfile = ProfileSession(os.path.splitext(filename)[0])
+
+def StopProfiling():
+    global activeProfile
+    if activeProfile is not None:
+        profileSession = activeProfile
+        activeProfile = None
+        profileSession.Stop()
+##end Profiling-------------------------------------------------------------------------------------------------------------------
+
+##Shared keep-alive HTTP session used by every XIQ API call-----------------------------------------------------------------------
+def GetXiqSession():
+    global xiqSession
+    with xiqSessionLock:
+        if xiqSession is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, httpPoolSize))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Connection"] = "keep-alive"
+            xiqSession = session
+        return xiqSession
+
+##Every XIQ API call goes through here.  A token from /login is refreshed shortly before it expires, and a 401 triggers one
+##re-authentication and retry.  refreshToken=False is used by the /login call itself.  With rateLimitFeature each attempt waits
+##for the shared rate limiter and a throttled call is retried after its Retry-After.
+def XiqRequest(method, url, refreshToken=True, **kwargs):
+    limiter = GetRateLimiter()
+    retries = 0
+    while True:
+        if refreshToken and tokenExpiresAt and time.time() >= tokenExpiresAt - tokenRefreshMarginSeconds:
+            RefreshAccessToken(headers.get("Authorization"))
+        sentAuthorization = headers.get("Authorization")
+        response = SendXiqRequest(limiter, method, url, **kwargs)
+        if refreshToken and response.status_code == 401 and not XIQ_Token and XIQ_username:
+            if RefreshAccessToken(sentAuthorization):
+                CountMetric('unauthorized', retry=True)
+                response = SendXiqRequest(limiter, method, url, **kwargs)
+        if limiter is None:
+            return response
+        retryAfter = ThrottleDelay(response, retries)
+        if retryAfter is None:
+            limiter.Success()
+            return response
+        if retries >= rateLimitMaxRetries:
+            limiter.Throttled(retryAfter, retried=False)
+            return response
+        retries += 1
+        CountMetric('throttled', retry=True)
+        limiter.Throttled(retryAfter)
+
+def SendXiqRequest(limiter, method, url, **kwargs):
+    if limiter is not None:
+        limiter.Acquire()
+    metrics = runMetrics
+    if metrics is None:
+        return GetXiqSession().request(method, url, headers=headers, verify=True, timeout=(httpConnectTimeoutSeconds, httpReadTimeoutSeconds), **kwargs)
+    started = time.perf_counter()
+    try:
+        response = GetXiqSession().request(method, url, headers=headers, verify=True, timeout=(httpConnectTimeoutSeconds, httpReadTimeoutSeconds), **kwargs)
+    except Exception:
+        metrics.AddRequest(method, url, 'error', time.perf_counter() - started, 0)
+        raise
+    metrics.AddRequest(method, url, response.status_code, time.perf_counter() - started, len(response.content))
+    return response
+
+##Seconds to wait before retrying a throttled response (429, or 503 with Retry-After), None when the response was not throttled.
+##Retry-After may be delay seconds or an HTTP date; without it the wait doubles with every retry.
+def ThrottleDelay(response, retries):
+    retryAfter = response.headers.get("Retry-After")
+    if response.status_code != 429 and not (response.status_code == 503 and retryAfter):
+        return None
+    if retryAfter:
+        try:
+            return max(0.0, float(retryAfter))
+        except ValueError:
+            from email.utils import parsedate_to_datetime
+            try:
+                return max(0.0, parsedate_to_datetime(retryAfter).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return min(60.0, 2.0 ** retries)
+
+##Connections opened vs. reused across every pool of the shared session
+def GetPoolStats():
+    stats = {'requests': 0, 'connections_opened': 0, 'connections_reused': 0}
+    if xiqSession is None:
+        return stats
+    for adapter in set(xiqSession.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['requests'] += pool.num_requests
+            stats['connections_opened'] += pool.num_connections
+    stats['connections_reused'] = max(0, stats['requests'] - stats['connections_opened'])
+    return stats
+
+def PrintPoolStats():
+    stats = GetPoolStats()
+    print(f"{colorWhite}HTTP pool: {stats['requests']} requests, {stats['connections_opened']} connections opened, {stats['connections_reused']} reused (pool size {httpPoolSize})\n")
+##end Shared keep-alive HTTP session-------------------------------------------------------------------------------------------
+
+##Adaptive client-side rate limiter shared by every XIQ API call (rateLimitFeature)-----------------------------------------------
+##Token bucket refilled at the current rate.  The rate follows AIMD: every successful call adds 1/rate request per second (about
+##one request per second per second), a throttled call halves it once per Retry-After window and pauses all callers until then.
+class RateLimiter:
+    def __init__(self, maxRate, minRate, burst):
+        self.maxRate = max(float(maxRate), 0.1)
+        self.minRate = min(max(float(minRate), 0.1), self.maxRate)
+        self.rate = self.maxRate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.refilled = time.monotonic()
+        self.pausedUntil = 0.0
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'throttled': 0, 'retries': 0, 'waitSeconds': 0.0, 'lowestRate': self.rate, 'throttledAtRate': None}
+
+    ##Block until a request may be sent
+    def Acquire(self):
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                delay = self.pausedUntil - now
+                if delay <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.stats['requests'] += 1
+                        self.stats['waitSeconds'] += waited
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def Success(self):
+        with self.lock:
+            if self.rate < self.maxRate:
+                self.rate = min(self.maxRate, self.rate + 1 / self.rate)
+
+    def Throttled(self, retryAfter, retried=True):
+        with self.lock:
+            now = time.monotonic()
+            self.stats['throttled'] += 1
+            if retried:
+                self.stats['retries'] += 1
+            if now >= self.pausedUntil:  #concurrent 429s from the same window only lower the rate once
+                self.stats['throttledAtRate'] = round(self.rate, 2)
+                self.rate = max(self.minRate, self.rate / 2)
+                self.stats['lowestRate'] = min(self.stats['lowestRate'], self.rate)
+                self.tokens = 0.0
+            self.pausedUntil = max(self.pausedUntil, now + retryAfter)
+
+    ##Snapshot of the limiter state for tuning per tenant
+    def Stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update({'rate': round(self.rate, 2), 'maxRate': self.maxRate, 'minRate': self.minRate, 'burst': self.burst,
+                          'lowestRate': round(stats['lowestRate'], 2), 'waitSeconds': round(stats['waitSeconds'], 2)})
+            return stats
+
+def GetRateLimiter():
+    global rateLimiter
+    if rateLimitFeature != 'ENABLE':
+        return None
+    with rateLimiterLock:
+        if rateLimiter is None:
+            rateLimiter = RateLimiter(rateLimitMaxPerSecond, rateLimitMinPerSecond, rateLimitBurst)
+        return rateLimiter
+
+def PrintRateLimiterStats():
+    if rateLimiter is None:
+        return
+    stats = rateLimiter.Stats()
+    print(f"{colorWhite}Rate limiter: {stats['requests']} requests, {stats['throttled']} throttled (429), {stats['retries']} retried, "
+          f"{stats['waitSeconds']} s waited across callers.  Rate now {stats['rate']} req/s (max {stats['maxRate']:g}, lowest {stats['lowestRate']}"
+          + (f", last throttled at {stats['throttledAtRate']}" if stats['throttledAtRate'] is not None else '') + ")\n")
+##end Adaptive client-side rate limiter-------------------------------------------------------------------------------------------
+
 ##Use provided credentials to acquire the access token if none was provided-------------------------
-def GetaccessToken(XIQ_username, XIQ_password):
+def GetaccessToken(XIQ_username, XIQ_password, useCache=True):
+    global tokenExpiresAt
+    if useCache and tokenCacheFeature == 'ENABLE':
+        cachedToken = ReadTokenCache(XIQ_username)
+        if cachedToken is not None:
+            headers["Authorization"] = "Bearer " + cachedToken['access_token']
+            tokenExpiresAt = cachedToken['expires_at']
+            return 0
     url = URL + "/login"
     payload = json.dumps({"username": XIQ_username, "password": XIQ_password})
-    response = requests.post(url, headers=headers, data=payload)
+    response = XiqRequest("POST", url, refreshToken=False, data=payload)
     if response is None:
         log_msg = "ERROR: Not able to login into ExtremeCloudIQ - no response!"
         raise TypeError(log_msg)
@@ -119,269 +1095,757 @@ def GetaccessToken(XIQ_username, XIQ_password):
     data = response.json()
     if "access_token" in data:
         headers["Authorization"] = "Bearer " + data["access_token"]
+        tokenExpiresAt = time.time() + data["expires_in"] if data.get("expires_in") else 0
+        if tokenCacheFeature == 'ENABLE':
+            WriteTokenCache(XIQ_username, data["access_token"], tokenExpiresAt)
         return 0
     else:
         log_msg = "Unknown Error: Unable to gain access token"
         raise TypeError(log_msg)
 ##end Use provided credentials to acquire the access token if none was provided-------------------------
 
-##Get Device Hostnames if Real / Connected / Audit Mismatch is True----------------------------------------------------------
-def GetDeviceOnlineList(ccgMembersIDs):
-    page = 1
-    pageCount = 1
-    pageSize = 100
-    foundDevices = []
-    updatedDeviceIDs = []
-    updatedDeviceHostnames = []
-    while page <= pageCount:
-        url = URL + "/devices?page=" + str(page) + "&limit=" + str(pageSize) + "&connected=true&adminStates=MANAGED&views=FULL&deviceTypes=REAL&configMismatch=true"
+##Log in again after a 401 or when the token is about to expire.  Threads that sent the same stale token share one login.
+def RefreshAccessToken(staleAuthorization):
+    with tokenLock:
+        if headers.get("Authorization") != staleAuthorization:
+            return True  #another thread already replaced the token
         try:
-            rawList = requests.get(url, headers=headers, verify = True)
-        except ValueError as e:
-            print('script is exiting...')
-            raise SystemExit
+            GetaccessToken(XIQ_username, XIQ_password, useCache=False)
+        except TypeError as e:
+            print(f'{colorRed}{e}')
+            return False
+        return True
+
+##Token cache file (tokenCacheFeature) - only the token, its expiry, the API URL and the username are stored, never the password
+def ReadTokenCache(cacheUsername):
+    try:
+        with open(os.path.join(PATH, tokenCacheFile)) as cacheFile:
+            cachedToken = json.load(cacheFile)
+    except (OSError, ValueError):
+        return None
+    if cachedToken.get('url') != URL or cachedToken.get('username') != cacheUsername or not cachedToken.get('access_token'):
+        return None
+    if time.time() >= cachedToken.get('expires_at', 0) - tokenRefreshMarginSeconds:
+        return None
+    return cachedToken
+
+def WriteTokenCache(cacheUsername, accessToken, expiresAt):
+    cachePath = os.path.join(PATH, tokenCacheFile)
+    tempPath = cachePath + '.tmp'
+    try:
+        cacheFd = os.open(tempPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)  #owner read/write only
+        with os.fdopen(cacheFd, 'w') as cacheFile:
+            json.dump({'url': URL, 'username': cacheUsername, 'access_token': accessToken, 'expires_at': expiresAt}, cacheFile)
+        os.chmod(tempPath, 0o600)
+        os.replace(tempPath, cachePath)
+    except OSError as e:
+        print(f'{colorOrange}Unable to write the token cache "{tokenCacheFile}": {e}')
+
+##Request a single page from XIQ and return the decoded JSON, exits the script when the page still fails after pageRetryMax retries------
+def FetchPage(url):
+    return FetchPageWithSize(url)[0]
+
+##Same as FetchPage but also returns the size in bytes of the response body.  Connection errors, unreadable bodies and the
+##pageRetryStatusCodes are retried after a full jitter backoff:  a random delay up to a cap that doubles with every retry, so the
+##page workers that failed together do not retry together.
+def FetchPageWithSize(url):
+    retries = 0
+    while True:
+        rawList = None
+        try:
+            rawList = XiqRequest("GET", url)
+            if rawList.status_code == 200:
+                return rawList.json(),len(rawList.content)
+            failure = 'HTTP ' + str(rawList.status_code)
+            retryable = rawList.status_code in pageRetryStatusCodes
         except Exception as e:
-            print('script is exiting...')
-            raise SystemExit
-        if rawList.status_code != 200:
-            print('Error exiting script...')
-            print(rawList.text)
-            raise SystemExit
-        jsonDump = rawList.json()
-        for device in jsonDump['data']:
-            newData = {}
-            newData['HOSTNAME'] = device['hostname']
-            if device['device_function']: 
-                newData['TYPE'] = device['device_function']
+            failure = type(e).__name__
+            retryable = True
+        if not retryable or retries >= pageRetryMax:
+            if rawList is not None and rawList.status_code != 200:
+                print('Error exiting script...')
+                print(rawList.text)
             else:
-                newData['TYPE'] = 'Unknown'
-            newData['STATUS'] = 'Online'
-            newData['AUDIT FLAG'] = 'Mismatch'
-            if device['locations']:
-                newData['BUILDING'] = device['locations'][-2]['name']
-                newData['FLOOR'] = device['locations'][-1]['name']
-            else:
-                newData['BUILDING'] = 'No Location'
-                newData['FLOOR'] = 'No Floor'
-            if device['id'] in ccgMembersIDs:
-                newData['CCG-' + ccgName] = 'Yes'
-                if readOnlyMode != 'ENABLE':
-                    updatedDeviceIDs.append(device['id'])
-                    updatedDeviceHostnames.append(device['hostname'])
-                    newData['UPDATED'] = 'Yes'
-                else:
-                    newData['UPDATED'] = 'Read-Only'
-            else:
-                newData['CCG-' + ccgName] = 'No'
-                newData['UPDATED'] = 'Not in CCG'
-            if device['software_version']: 
-                newData['SOFTWARE'] = device['software_version']
-            else:
-                newData['SOFTWARE'] = 'Unknown'
-            if device['ip_address']: 
-                newData['IP'] = device['ip_address']
-            else:
-                newData['IP'] = 'Unknown'
-            if device['network_policy_name']: 
-                newData['POLICY'] = device['network_policy_name']
-            else:
-                newData['POLICY'] = 'Unknown'
-            if device['product_type']: 
-                newData['MODEL'] = device['product_type']
-            else:
-                newData['MODEL'] = 'Unknown'
-            newData['LAST SEEN'] = 'Now'
-            foundDevices.append(newData)
-        pageCount = jsonDump['total_pages']
-        print(f"\n{colorGreen}Completed page {page} of {jsonDump['total_pages']} collecting Online devices")
-        page = jsonDump['page'] + 1
-    if updatedDeviceIDs != []:
-        UpdateCcgTaggedDeviceDelta(updatedDeviceHostnames,updatedDeviceIDs)
+                print(f'{colorRed}{failure} reading {url[len(URL):]}')
+                print('script is exiting...')
+            raise SystemExit
+        retries += 1
+        delay = random.uniform(0, min(pageRetryMaxSeconds, pageRetryBaseSeconds * 2 ** (retries - 1)))
+        print(f'{colorOrange}{failure} reading {url[len(URL):]}, retry {retries} of {pageRetryMax} in {delay:.1f} s')
+        CountMetric('page', retry=True)
+        time.sleep(delay)
+##end Request a single page from XIQ-----------------------------------------------------------------------------------------------
+
+##Pick the view for a device sweep.  With sweepProjection only the fields the CSV needs are requested; a small probe confirms XIQ
+##returned all of them (otherwise the sweep falls back to views=FULL) and a FULL probe of the same size estimates the bytes saved.
+def DeviceSweepView(deviceFilters, projectFields, pageLabel):
+    fullView = "&views=FULL"
+    if sweepProjection != 'ENABLE' or not projectFields:
+        return fullView
+    projectedView = "&views=BASIC" + ''.join("&fields=" + field.upper() for field in projectFields)
+    probeUrl = URL + "/devices?page=1&limit=" + str(projectionProbeSize) + deviceFilters
+    projectedProbe,projectedBytes = FetchPageWithSize(probeUrl + projectedView)
+    if not projectedProbe['data']:
+        return projectedView
+    missingFields = [field for field in projectFields if not any(field in device for device in projectedProbe['data'])]
+    if missingFields:
+        print(f"\n{colorOrange}Field projection is missing {', '.join(missingFields)} while {pageLabel}, falling back to views=FULL")
+        with projectionStatsLock:
+            projectionStats['fallbacks'].append(pageLabel)
+        return fullView
+    fullProbe,fullBytes = FetchPageWithSize(probeUrl + fullView)
+    probeCount = len(projectedProbe['data'])
+    bytesSaved = (fullBytes - projectedBytes) * projectedProbe.get('total_count', probeCount) // probeCount
+    with projectionStatsLock:
+        projectionStats['devices'] += projectedProbe.get('total_count', probeCount)
+        projectionStats['bytesSaved'] += max(0, bytesSaved)
+    return projectedView
+
+def ResetProjectionStats():
+    with projectionStatsLock:
+        projectionStats.update({'devices': 0, 'bytesSaved': 0, 'fallbacks': []})
+
+def PrintProjectionStats():
+    if sweepProjection != 'ENABLE':
+        return
+    with projectionStatsLock:
+        kbSaved = projectionStats['bytesSaved'] / 1024
+        message = f"Field projection: ~{kbSaved:,.0f} KB saved versus views=FULL across {projectionStats['devices']} devices"
+        if projectionStats['fallbacks']:
+            message += " (views=FULL used for: " + ', '.join(projectionStats['fallbacks']) + ")"
+    print(f"{colorWhite}{message}\n")
+##end Pick the view for a device sweep-------------------------------------------------------------------------------------------
+
+##Yield every page of a /devices query in page order, sequentially or with a bounded worker pool (parallelPagination)------------
+##projectFields lists the device fields the caller reads, used by sweepProjection to request a smaller view
+def GetDevicePages(deviceFilters, pageColor, pageLabel, projectFields=None):
+    sweepPlan = PlanDeviceSweep(deviceFilters) if sweepPlanner == 'ENABLE' else None  #before the view probes, a one page sweep skips them
+    if sweepPlan is not None and sweepPlan['pages'] <= 1:
+        print(f"\n{pageColor}Sweep plan: {sweepPlan['devices']} device(s) {pageLabel}, answered by page 1")
+        yield sweepPlan['probe']
+        return
+    deviceFilters = deviceFilters + DeviceSweepView(deviceFilters, projectFields, pageLabel)
+    if sweepPlan is not None:
+        yield from GetPlannedDevicePages(deviceFilters, pageColor, pageLabel, sweepPlan)
+        return
+    if parallelPagination != 'ENABLE':
+        page = 1
+        pageCount = 1
+        while page <= pageCount:
+            jsonDump = FetchSweepPage(URL + "/devices?page=" + str(page) + "&limit=" + str(pageSize) + deviceFilters)
+            pageCount = jsonDump['total_pages']
+            print(f"\n{pageColor}Completed page {page} of {jsonDump['total_pages']} {pageLabel}")
+            page = jsonDump['page'] + 1
+            yield jsonDump
+        return
+    jsonDump = FetchSweepPage(URL + "/devices?page=1&limit=" + str(pageSize) + deviceFilters)
+    pageCount = jsonDump['total_pages']
+    print(f"\n{pageColor}Completed page 1 of {pageCount} {pageLabel}")
+    yield jsonDump
+    if pageCount <= 1:
+        return
+    urls = [URL + "/devices?page=" + str(page) + "&limit=" + str(pageSize) + deviceFilters for page in range(2, pageCount + 1)]
+    from concurrent.futures import ThreadPoolExecutor
+    executor = ThreadPoolExecutor(max_workers=max(1, pageWorkers))
+    try:
+        for page, jsonDump in enumerate(executor.map(FetchSweepPage, urls), start=2):  #map() hands pages back in request order
+            print(f"\n{pageColor}Completed page {page} of {pageCount} {pageLabel}")
+            yield jsonDump
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+##Size a sweep from its page 1 (sweepPlanner), requested with plannerMaxPageSize and views=FULL so it is also the first page of the sweep.
+##Returns the plan:  device count, page size, page count, workers and page 1.  Returns None when XIQ did not report total_count; page 1
+##is then requested again by the unplanned sweep.
+def PlanDeviceSweep(deviceFilters):
+    pageSize = max(1, plannerMaxPageSize)
+    started = time.perf_counter()
+    probe = FetchSweepPage(URL + "/devices?page=1&limit=" + str(pageSize) + deviceFilters + "&views=FULL")
+    probeSeconds = time.perf_counter() - started
+    deviceCount = probe.get('total_count')
+    if not isinstance(deviceCount, int):
+        return None
+    pageCount = max(1, probe['total_pages'], -(-deviceCount // pageSize))
+    sweepPlan = {'devices': deviceCount, 'pageSize': pageSize, 'pages': pageCount, 'workers': 1, 'probe': probe}
+    if parallelPagination == 'ENABLE' and pageCount > 2 and (pageCount - 1) * probeSeconds >= plannerSerialSeconds:
+        sweepPlan['workers'] = min(max(1, pageWorkers), pageCount - 1)
+    return sweepPlan
+
+##Yield the pages of a planned sweep in page order:  page 1 from the plan, then pages 2 and up.  Devices added after page 1 push the
+##page count up; the extra pages are read one at a time once the planned pages are in.
+def GetPlannedDevicePages(deviceFilters, pageColor, pageLabel, sweepPlan):
+    print(f"\n{pageColor}Sweep plan: {sweepPlan['devices']} device(s) {pageLabel} in {sweepPlan['pages']} page(s) of {sweepPlan['pageSize']}, "
+          f"{sweepPlan['workers']} worker(s)")
+    pageUrl = URL + "/devices?limit=" + str(sweepPlan['pageSize']) + deviceFilters + "&page="
+    pageCount = sweepPlan['pages']
+    print(f"\n{pageColor}Completed page 1 of {pageCount} {pageLabel}")
+    yield sweepPlan['probe']
+    page = 2
+    if sweepPlan['workers'] > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=sweepPlan['workers'])
+        try:
+            for page, jsonDump in enumerate(executor.map(FetchSweepPage, [pageUrl + str(page) for page in range(2, pageCount + 1)]), start=2):
+                pageCount = max(pageCount, jsonDump['total_pages'])
+                print(f"\n{pageColor}Completed page {page} of {pageCount} {pageLabel}")
+                yield jsonDump
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        page = sweepPlan['pages'] + 1
+    while page <= pageCount:
+        jsonDump = FetchSweepPage(pageUrl + str(page))
+        pageCount = max(pageCount, jsonDump['total_pages'])
+        print(f"\n{pageColor}Completed page {page} of {pageCount} {pageLabel}")
+        page += 1
+        yield jsonDump
+##end Yield every page of a /devices query---------------------------------------------------------------------------------------
+
+##Sweep checkpoint (checkpointFeature)-------------------------------------------------------------------------------------------
+##JSON lines file:  a header with the time the checkpointed run started, then one line per processed sweep page with its URL, page
+##number, total_pages (and total_count when XIQ sent it) and the device values of its records.  A page is restored only for the exact same URL (filters, view, page size
+##and page number).  Lines are flushed as they are written and a last line cut off by a crash is dropped.  Only the file offset of each
+##page is held in memory, its rows are read back when the sweep reaches the page.
+class SweepCheckpoint:
+    def __init__(self, checkpointPath):
+        self.path = checkpointPath
+        self.lock = threading.Lock()
+        self.offsets = {}  #page URL to file offset of the pages not restored yet
+        self.restoredIds = {}  #device IDs restored per sweep status, so a device that moved to a later page is not reported twice
+        self.loadedPages = 0
+        self.restoredPages = 0
+        self.savedPages = 0
+        self.reader = None
+        started = self.Load()
+        if started is None:
+            self.file = open(checkpointPath, 'w', newline='\n')
+            self.file.write(json.dumps({'checkpoint': 1, 'started': time.time()}) + '\n')
+            self.file.flush()
+        else:
+            self.reader = open(checkpointPath, 'rb')
+            self.file = open(checkpointPath, 'a', newline='\n')
+            print(f'{colorCyan}Resuming from sweep checkpoint "{checkpointFile}":  {self.loadedPages} page(s) read by a run started '
+                  + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)) + '\n')
+
+    ##Index the pages of a checkpoint left by an earlier run.  Returns the start time of that run, None when there is nothing to resume.
+    def Load(self):
+        try:
+            checkpointIn = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        with checkpointIn:
+            try:
+                header = json.loads(checkpointIn.readline())
+                started = float(header['started'])
+            except (ValueError, TypeError, KeyError):
+                print(f'{colorOrange}Sweep checkpoint "{checkpointFile}" is not readable, starting the sweeps at page 1')
+                return None
+            if time.time() - started > checkpointMaxAgeMinutes * 60:
+                print(f'{colorOrange}Sweep checkpoint "{checkpointFile}" is older than checkpointMaxAgeMinutes, starting the sweeps at page 1')
+                return None
+            offset = checkpointIn.tell()
+            for line in checkpointIn:
+                try:
+                    self.offsets[json.loads(line)['url']] = offset
+                except (ValueError, TypeError, KeyError):
+                    break
+                offset += len(line)
+        os.truncate(self.path, offset)  #drops a line cut off by a crash so appended pages start on a line of their own
+        self.loadedPages = len(self.offsets)
+        return started
+
+    ##The checkpointed page for url in the shape of a /devices page, None when the page has to be requested
+    def RestorePage(self, url):
+        with self.lock:
+            offset = self.offsets.pop(url, None)
+            if offset is None:
+                return None
+            self.reader.seek(offset)
+            page = json.loads(self.reader.readline())
+            self.restoredPages += 1
+        restored = {'page': page['page'], 'total_pages': page['total_pages'], 'data': [], 'checkpointRows': page['rows']}
+        if 'total_count' in page:
+            restored['total_count'] = page['total_count']  #lets a restored page 1 plan the sweep again
+        return restored
+
+    def SavePage(self, jsonDump, pageRecords):
+        savedPage = {'url': jsonDump['checkpointUrl'], 'page': jsonDump['page'], 'total_pages': jsonDump['total_pages']}
+        if 'total_count' in jsonDump:
+            savedPage['total_count'] = jsonDump['total_count']
+        savedPage['rows'] = [record.CheckpointValues() for record in pageRecords]
+        line = json.dumps(savedPage, separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+            self.savedPages += 1
+
+    ##A completed run deletes the checkpoint, a failed run leaves it for the next run
+    def Close(self, completed):
+        self.file.close()
+        if self.reader is not None:
+            self.reader.close()
+        if self.restoredPages:
+            print(f'{colorCyan}Sweep checkpoint: {self.restoredPages} page(s) restored, {self.savedPages} page(s) requested\n')
+        if completed or not (self.loadedPages or self.savedPages):
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        else:
+            print(f'{colorCyan}Sweep checkpoint "{checkpointFile}" keeps {self.loadedPages + self.savedPages} page(s) for the next run\n')
+
+def OpenSweepCheckpoint():
+    try:
+        return SweepCheckpoint(os.path.join(PATH, checkpointFile))
+    except OSError as e:
+        print(f'{colorOrange}Unable to open the sweep checkpoint "{checkpointFile}", running without it: {e}')
+        return None
+
+##FetchPage for the pages of the Online/Offline sweeps.  A page held by the sweep checkpoint is not requested again; a requested page
+##carries its URL so SweepPageRecords can add it to the checkpoint.
+def FetchSweepPage(url):
+    checkpoint = sweepCheckpoint
+    if checkpoint is None:
+        return FetchPage(url)
+    jsonDump = checkpoint.RestorePage(url)
+    if jsonDump is None:
+        jsonDump = FetchPage(url)
+        jsonDump['checkpointUrl'] = url
+    return jsonDump
+
+##DeviceRecords of one sweep page:  restored from the checkpoint, or normalized from the response and then checkpointed
+def SweepPageRecords(jsonDump, status, auditFlag, ccgGroups, updatedInCcg, updatedNotInCcg, lastSeen=None):
+    checkpoint = sweepCheckpoint
+    if 'checkpointRows' in jsonDump:
+        pageRecords = RestoreDevicePage(jsonDump['checkpointRows'], status, auditFlag, ccgGroups, updatedInCcg, updatedNotInCcg)
+        checkpoint.restoredIds.setdefault(status, set()).update(record.deviceId for record in pageRecords)
+        CountMetric('restored', len(pageRecords))
+        return pageRecords
+    pageRecords = NormalizeDevicePage(jsonDump['data'], status, auditFlag, ccgGroups, updatedInCcg, updatedNotInCcg, lastSeen)
+    if 'checkpointUrl' in jsonDump and checkpoint is not None:
+        restoredIds = checkpoint.restoredIds.get(status)
+        if restoredIds:
+            pageRecords = [record for record in pageRecords if record.deviceId not in restoredIds]
+        checkpoint.SavePage(jsonDump, pageRecords)
+    return pageRecords
+##end Sweep checkpoint-----------------------------------------------------------------------------------------------------------
+
+##Get Device Hostnames if Real / Connected / Audit Mismatch is True----------------------------------------------------------
+@TimedPhase('online_sweep')
+def GetDeviceOnlineList(ccgGroups, reportSink):
+    foundHostnames = []
+    updatedDeviceIDs = []
+    updatedDeviceHostnames = []
+    if readOnlyMode != 'ENABLE':
+        updatedInCcg = 'Yes'
     else:
-        print(f"\n{colorGreen}No online devices found with an audit mismatch and member of the CCG")
-    return foundDevices,updatedDeviceIDs,updatedDeviceHostnames
+        updatedInCcg = 'Read-Only'
+    for jsonDump in GetDevicePages("&connected=true&adminStates=MANAGED&deviceTypes=REAL&configMismatch=true", colorGreen, "collecting Online devices", onlineSweepFields):
+        pageRecords = SweepPageRecords(jsonDump, 'Online', 'Mismatch', ccgGroups, updatedInCcg, 'Not in CCG', 'Now')
+        for record in pageRecords:
+            if record.updated == 'Yes':
+                updatedDeviceIDs.append(record.deviceId)
+                updatedDeviceHostnames.append(record.hostname)
+            foundHostnames.append(record.hostname)
+        reportSink.AddRows(pageRecords)
+        CountMetric('online', len(pageRecords))
+    return foundHostnames,updatedDeviceIDs,updatedDeviceHostnames
 ##end Get Device Hostnames if Real / Connected / Audit Mismatch is True----------------------------------------------------------
 
 ##Get Device Hostnames if Real / Disconnected------------------------------------------------------------------------------------
-def GetDeviceOfflineList(ccgMembersIDs):
-    page = 1
-    pageCount = 1
-    pageSize = 100
-    foundDevices = []
-    while page <= pageCount:
-        url = URL + "/devices?page=" + str(page) + "&limit=" + str(pageSize) + "&connected=false&adminStates=MANAGED&views=FULL&deviceTypes=REAL"
-        try:
-            rawList = requests.get(url, headers=headers, verify = True)
-        except ValueError as e:
-            print('script is exiting...')
-            raise SystemExit
-        except Exception as e:
-            print('script is exiting...')
-            raise SystemExit 
-        if rawList.status_code != 200:
-            print('Error exiting script...')
-            print(rawList.text)
-            raise SystemExit
-        jsonDump = rawList.json()
-        for device in jsonDump['data']:
-            newData = {}
-            newData['HOSTNAME'] = device['hostname']
-            if 'device_function' in device and device['device_function']:
-                newData['TYPE'] = device['device_function']
-            else:
-                newData['TYPE'] = 'Unknown'
-            newData['STATUS'] = 'Offline'
-            newData['AUDIT FLAG'] = 'Unknown'
-            if device['locations']:
-                newData['BUILDING'] = device['locations'][-2]['name']
-                newData['FLOOR'] = device['locations'][-1]['name']
-            else:
-                newData['BUILDING'] = 'No Location'
-                newData['FLOOR'] = 'No Floor'
-            if device['id'] in ccgMembersIDs:
-                newData['CCG-' + ccgName] = 'Yes'
-            else:
-                newData['CCG-' + ccgName] = 'No'
-            newData['UPDATED'] = 'N/A'
-            if device['software_version']: 
-                newData['SOFTWARE'] = device['software_version']
-            else:
-                newData['SOFTWARE'] = 'Unknown'
-            if 'ip_address' in device and device['ip_address']:
-                newData['IP'] = device['ip_address']
-            else:
-                newData['IP'] = 'Unknown'
-            if device['network_policy_name']: 
-                newData['POLICY'] = device['network_policy_name']
-            else:
-                newData['POLICY'] = 'Unknown'
-            if device['product_type']: 
-                newData['MODEL'] = device['product_type']
-            else:
-                newData['MODEL'] = 'Unknown'
-            if 'last_connect_time' in device and device['last_connect_time']:
-                newData['LAST SEEN'] = device['last_connect_time']
-            else:
-                newData['LAST SEEN'] = 'Check if device has ever connected to XIQ'
-            foundDevices.append(newData)
-        pageCount = jsonDump['total_pages']
-        print(f"\n{colorGrey}Completed page {page} of {jsonDump['total_pages']} collecting Offline devices")
-        page = jsonDump['page'] + 1
-    return foundDevices
-##end Get Device Hostnames if Real / Disconnected--------------------------------------------------------------------------------
-
-##Send email
-def SendMail(fromaddr, toaddr, email_body, email_subject, smtpsrv, smtpport, reportName):
-        # Build the email
-        toHeader = ", ".join(toaddr)
-        msg = MIMEMultipart()
-        msg['Subject'] = email_subject
-        msg['From'] = fromaddr
-        msg['To'] = toHeader
-        msg.attach(MIMEText(email_body))
-        part = MIMEBase('application', "octet-stream")
-        part.set_payload(open(f"{PATH}/{filename}", "rb").read())
-        encoders.encode_base64(part)
-        part.add_header('Content-Disposition', f'attachment; filename="{reportName}"')
-        msg.attach(part)
-        try:
-            server = smtplib.SMTP(smtpsrv, smtpport)
-            server.starttls()
-            server.login(username,password)
-            server.send_message(msg)
-            server.quit()
-            #debug_print "email sent: %s" % fromaddr
-        except Exception as e:
-                logmsg = "Something went wrong when sending the email to {}".format(fromaddr)
-                raise TypeError(f"{logmsg}\n   {e}")
+@TimedPhase('offline_sweep')
+def GetDeviceOfflineList(ccgGroups, reportSink):
+    foundHostnames = []
+    for jsonDump in GetDevicePages("&connected=false&adminStates=MANAGED&deviceTypes=REAL", colorGrey, "collecting Offline devices", offlineSweepFields):
+        pageRecords = SweepPageRecords(jsonDump, 'Offline', 'Unknown', ccgGroups, 'N/A', 'N/A')
+        foundHostnames.extend(record.hostname for record in pageRecords)
+        reportSink.AddRows(pageRecords)
+        CountMetric('offline', len(pageRecords))
+    return foundHostnames
+##end Get Device Hostnames if Real / Disconnected----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+
+##Query only the CCG member devices that are Real / Connected / Audit Mismatch, in batches of device IDs (ccgTargetedQuery)---------
+@TimedPhase('ccg_member_query')
+def GetCcgMemberMismatches(ccgGroups):
+    updatedDeviceIDs = []
+    updatedDeviceHostnames = []
+    memberIds = list(dict.fromkeys(deviceId for group in ccgGroups for deviceId in group.members))
+    batchSize = max(1, ccgQueryBatchSize)
+    for start in range(0, len(memberIds), batchSize):
+        idFilter = ''.join("&ids=" + str(deviceId) for deviceId in memberIds[start:start + batchSize])
+        for jsonDump in GetDevicePages("&connected=true&adminStates=MANAGED&deviceTypes=REAL&configMismatch=true" + idFilter, colorGreen, "querying CCG member devices"):
+            for device in jsonDump['data']:
+                if any(device['id'] in group.members for group in ccgGroups):
+                    updatedDeviceIDs.append(device['id'])
+                    updatedDeviceHostnames.append(device['hostname'])
+    if readOnlyMode == 'ENABLE':
+        if updatedDeviceHostnames != []:
+            print(f'\n{colorGreen}Read-Only: CCG member(s) online with an audit mismatch: ' + ', '.join(updatedDeviceHostnames))
+        return [],[]
+    return updatedDeviceIDs,updatedDeviceHostnames
+##end Query only the CCG member devices-------------------------------------------------------------------------------------------
+
+##Full fleet report schedule used with ccgTargetedQuery, the stamp file holds the epoch time of the last full report
+def FullReportDue():
+    if ccgTargetedQuery != 'ENABLE' or fullReportIntervalMinutes <= 0:
+        return True
+    try:
+        with open(os.path.join(PATH, fullReportStampFile)) as stampFile:
+            lastReport = float(stampFile.read().strip() or 0)
+    except (OSError, ValueError):
+        return True
+    return time.time() - lastReport >= fullReportIntervalMinutes * 60
+
+def MarkFullReport():
+    if ccgTargetedQuery == 'ENABLE' and fullReportIntervalMinutes > 0:
+        with open(os.path.join(PATH, fullReportStampFile), 'w') as stampFile:
+            stampFile.write(str(time.time()))
+
+##Email outbox (emailFeature)----------------------------------------------------------------------------------------------------------
+##Queue the report email in outboxDir.  The CSV is zipped into a temporary file and base64 encoded outboxChunkBytes at a time straight into
+##the .eml file, so neither the CSV nor the attachment is held in memory.  The .json envelope is written last and a sender only picks up
+##emails that have one, so a half written email is never sent.  Returns the ID of the queued email.
+@TimedPhase('email_queue')
+def QueueMail(fromaddr, toaddr, email_body, email_subject, smtpsrv, smtpport, reportName):
+    import base64
+    import tempfile
+    import uuid
+    import zipfile
+    from email.header import Header
+    from email.utils import formatdate, make_msgid
+    outboxPath = os.path.join(PATH, outboxDir)
+    os.makedirs(outboxPath, exist_ok=True)
+    mailId = time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8]
+    emlPath = os.path.join(outboxPath, mailId + '.eml')
+    attachmentName = os.path.splitext(os.path.basename(reportName))[0] + '.zip'
+    boundary = '===============' + uuid.uuid4().hex
+    mailHeaders = [
+        'From: ' + fromaddr,
+        'To: ' + ', '.join(toaddr),
+        'Subject: ' + Header(email_subject, 'us-ascii' if email_subject.isascii() else 'utf-8').encode(),
+        'Date: ' + formatdate(localtime=True),
+        'Message-ID: ' + make_msgid(domain=fromaddr.rpartition('@')[2] or None),
+        'MIME-Version: 1.0',
+        f'Content-Type: multipart/mixed; boundary="{boundary}"',
+        '',
+        f'--{boundary}',
+        'Content-Type: text/plain; charset="utf-8"',
+        'Content-Transfer-Encoding: base64',
+        '',
+        base64.encodebytes(email_body.encode('utf-8')).decode('ascii').replace('\n', '\r\n'),
+        f'--{boundary}',
+        f'Content-Type: application/zip; name="{attachmentName}"',
+        'Content-Transfer-Encoding: base64',
+        f'Content-Disposition: attachment; filename="{attachmentName}"',
+        '', '']
+    with tempfile.TemporaryFile(dir=outboxPath) as zipped:
+        with zipfile.ZipFile(zipped, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.write(reportName, os.path.basename(reportName))
+        zipped.seek(0)
+        with open(emlPath + '.tmp', 'wb') as eml:
+            eml.write('\r\n'.join(mailHeaders).encode('utf-8'))
+            while True:
+                chunk = zipped.read(outboxChunkBytes)
+                if not chunk:
+                    break
+                eml.write(base64.encodebytes(chunk).replace(b'\n', b'\r\n'))
+            eml.write(f'--{boundary}--\r\n'.encode('ascii'))
+    os.replace(emlPath + '.tmp', emlPath)
+    envelope = {'from': fromaddr, 'to': list(toaddr), 'subject': email_subject, 'smtp_server': smtpsrv, 'smtp_port': smtpport, 'tenant': tenantName,
+                'queued': time.time(), 'attempts': 0, 'next_attempt': 0, 'last_error': ''}
+    WriteOutboxEnvelope(os.path.join(outboxPath, mailId + '.json'), envelope)
+    return mailId
+
+def WriteOutboxEnvelope(envelopePath, envelope):
+    with open(envelopePath + '.tmp', 'w') as envelopeFile:
+        json.dump(envelope, envelopeFile)
+    os.replace(envelopePath + '.tmp', envelopePath)
+
+##Hand the queued email to the sender.  The sender is a separate process so the audit (or the next watch cycle) never waits on the SMTP
+##server; its screen output goes to outboxDir/sender.log.  Tenant workers start it the same way, it sends the tenant queues too.
+##A run that prompted for credentials has someone at the terminal and sends the queue itself, like earlier versions sent the email.
+def StartOutboxSender():
+    if credentialsPrompted:
+        DrainOutbox()
+    elif outboxSender == 'BACKGROUND':
+        import subprocess
+        with open(os.path.join(PATH, outboxDir, 'sender.log'), 'a') as senderLog:
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), '--drain-outbox'], cwd=PATH, stdin=subprocess.DEVNULL,
+                             stdout=senderLog, stderr=subprocess.STDOUT, start_new_session=True)
+    else:
+        print(f'{colorWhite}The email stays queued until the sender runs:  python3 {os.path.basename(__file__)} --drain-outbox')
+
+##Send every queued email that is due, from outboxDir and the tenant=<name> queues of multi-tenant mode.  A sender claims an email by
+##renaming its envelope, so several senders (cron and the processes started after runs) never send the same email twice.  A failed
+##email waits 1, 2, 4 ... up to 60 minutes before its next attempt and is moved to the failed folder of its queue after outboxMaxAttempts attempts.
+def DrainOutbox():
+    import smtplib
+    outboxPath = os.path.join(PATH, outboxDir)
+    if not os.path.isdir(outboxPath):
+        print(f'{colorWhite}Email outbox "{outboxDir}" is empty.')
+        return
+    queuePaths = [outboxPath] + [os.path.join(outboxPath, name) for name in sorted(os.listdir(outboxPath))
+                                 if name.startswith('tenant=') and os.path.isdir(os.path.join(outboxPath, name))]
+    for queuePath in queuePaths:
+        for name in os.listdir(queuePath):
+            claimPath = os.path.join(queuePath, name)
+            try:
+                if name.endswith('.json.sending') and time.time() - os.path.getmtime(claimPath) > outboxClaimSeconds:
+                    os.replace(claimPath, claimPath[:-len('.sending')])  #the sender that claimed it did not finish
+            except OSError:
+                pass
+    drainStarted = time.perf_counter()
+    sent = failed = waiting = 0
+    server = None
+    serverAddress = None
+    tenantLogins = None
+    try:
+        for queuePath in queuePaths:
+            queueName = os.path.relpath(queuePath, PATH)
+            for name in sorted(os.listdir(queuePath)):
+                if not name.endswith('.json'):
+                    continue
+                envelopePath = os.path.join(queuePath, name)
+                claimPath = envelopePath + '.sending'
+                emlPath = envelopePath[:-len('.json')] + '.eml'
+                try:
+                    os.rename(envelopePath, claimPath)
+                except OSError:
+                    continue  #claimed by another sender
+                try:
+                    with open(claimPath) as envelopeFile:
+                        envelope = json.load(envelopeFile)
+                except (OSError, ValueError) as e:
+                    print(f'{colorRed}Queued email "{name}" has an unreadable envelope and is moved to "{queueName}/failed": {e}')
+                    MoveFailedMail(queuePath, claimPath, emlPath)
+                    failed += 1
+                    continue
+                if envelope['next_attempt'] > time.time():
+                    os.replace(claimPath, envelopePath)
+                    waiting += 1
+                    continue
+                if envelope.get('tenant') and tenantLogins is None:
+                    tenantLogins = ReadTenantSmtpLogins()
+                smtpLogin = tenantLogins.get(envelope['tenant'], (username, password)) if envelope.get('tenant') else (username, password)
+                try:
+                    if server is None or serverAddress != (envelope['smtp_server'], envelope['smtp_port'], smtpLogin):
+                        if server is not None:
+                            server.quit()
+                        server = None
+                        serverAddress = (envelope['smtp_server'], envelope['smtp_port'], smtpLogin)
+                        server = smtplib.SMTP(envelope['smtp_server'], envelope['smtp_port'], timeout=60)
+                        server.starttls()
+                        server.login(*smtpLogin)
+                    with open(emlPath, 'rb') as eml:
+                        server.sendmail(envelope['from'], envelope['to'], eml.read())
+                except Exception as e:
+                    failed += 1
+                    if server is not None:
+                        try:
+                            server.close()
+                        except Exception:
+                            pass
+                    server = None
+                    envelope['attempts'] += 1
+                    envelope['last_error'] = str(e)
+                    if envelope['attempts'] >= outboxMaxAttempts:
+                        print(f'{colorRed}Email "{envelope["subject"]}" failed {envelope["attempts"]} times and is moved to "{queueName}/failed": {e}')
+                        WriteOutboxEnvelope(claimPath, envelope)
+                        MoveFailedMail(queuePath, claimPath, emlPath)
+                    else:
+                        retryMinutes = min(60, 2 ** (envelope['attempts'] - 1))
+                        envelope['next_attempt'] = time.time() + retryMinutes * 60
+                        print(f'{colorOrange}Email "{envelope["subject"]}" not sent (attempt {envelope["attempts"]} of {outboxMaxAttempts}), retry in {retryMinutes} min: {e}')
+                        WriteOutboxEnvelope(claimPath, envelope)
+                        os.replace(claimPath, envelopePath)
+                    continue
+                os.remove(emlPath)
+                os.remove(claimPath)
+                sent += 1
+                print(f'{colorGreen}Email "{envelope["subject"]}" sent to: ' + ','.join(envelope['to']))
+    finally:
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                pass
+    print(f'{colorWhite}Email outbox "{outboxDir}":  {sent} sent, {failed} failed, {waiting} waiting for their next attempt')
+    if metricsFeature == 'ENABLE':
+        WriteMailMetrics(sent, failed, waiting, time.perf_counter() - drainStarted)
+
+##SMTP login of every tenant in tenantConfigFile:  its own username/password, or the settings above for the ones it does not list
+def ReadTenantSmtpLogins():
+    try:
+        with open(os.path.join(PATH, tenantConfigFile)) as configFile:
+            return {tenant['name']: (tenant.get('username', username), tenant.get('password', password)) for tenant in json.load(configFile)}
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        print(f'{colorOrange}Unable to read the tenant SMTP logins from "{tenantConfigFile}", using username/password: {e}')
+        return {}
+
+def MoveFailedMail(outboxPath, claimPath, emlPath):
+    failedPath = os.path.join(outboxPath, 'failed')
+    os.makedirs(failedPath, exist_ok=True)
+    for queuedPath in (claimPath, emlPath):
+        if os.path.exists(queuedPath):
+            os.replace(queuedPath, os.path.join(failedPath, os.path.basename(queuedPath).replace('.json.sending', '.json')))
+
 ##end SMTP Relay for email alerts section ---------------------------------------------------------
 
-##Gather device IDs if member of the CCG
-def LocateCcgMemberIds():
+##Fetch a single CCG by ID, returns None when it no longer exists or was renamed
+def GetCcgById(ccgID, ccgNameLocal):
+    try:
+        response = XiqRequest("GET", URL + "/ccgs/" + ccgID)
+    except Exception as e:
+        return None
+    if response.status_code != 200:
+        return None
+    ccgObj = response.json()
+    if ccgObj.get('name') != ccgNameLocal:
+        return None
+    return ccgObj
+
+##CCG name to ID cache file, ignored when it was written for another XIQ URL
+def ReadCcgIdCache():
+    try:
+        with open(os.path.join(PATH, ccgCacheFile)) as cacheFile:
+            cachedIds = json.load(cacheFile)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cachedIds, dict) or cachedIds.get('url') != URL or not isinstance(cachedIds.get('ccgs'), dict):
+        return {}
+    return cachedIds['ccgs']
+
+def WriteCcgIdCache():
+    cachePath = os.path.join(PATH, ccgCacheFile)
+    tempPath = cachePath + '.tmp'
+    try:
+        with open(tempPath, 'w') as cacheFile:
+            json.dump({'url': URL, 'ccgs': ccgIdCache}, cacheFile)
+        os.replace(tempPath, cachePath)
+    except OSError as e:
+        print(f'{colorOrange}Unable to write the CCG cache "{ccgCacheFile}": {e}')
+
+##Gather the device IDs of every update CCG, returns a CcgGroup per name in UpdateCcgNames() order.  A known ID (from this process or
+##ccgCacheFile) fetches the single CCG; the CCGs without a valid known ID are found by one paged /ccgs search that stops at the page
+##holding the last of them.
+@TimedPhase('ccg_lookup')
+def LocateCcgGroups():
+    names = UpdateCcgNames()
+    if any(name not in ccgIdCache for name in names):
+        ccgIdCache.update(ReadCcgIdCache())
+    foundGroups = {}
+    for name in names:
+        cachedID = ccgIdCache.get(name)
+        if cachedID:
+            ccgObj = GetCcgById(cachedID, name)
+            if ccgObj is not None:
+                print(f"{colorOrange}Using known ID {cachedID} for \"" + name + "\" CCG")
+                foundGroups[name] = CcgGroup(name, cachedID, ccgObj['device_ids'])
+                continue
+            print(f"{colorOrange}Known ID {cachedID} no longer matches \"" + name + "\" CCG, searching all CCGs")
+            ccgIdCache.pop(name, None)
+    missingNames = [name for name in names if name not in foundGroups]
     page = 1
     pageCount = 1
-    pageSize = 100
-    ccgID = ''
-    ccgMembersIDs = []
-    while page <= pageCount:
-        url = URL + "/ccgs?page=" + str(page) + "&limit=" + str(pageSize)
-        try:
-            rawList = requests.get(url, headers=headers, verify = True)
-        except ValueError as e:
-            print('script is exiting...')
-            raise SystemExit
-        except Exception as e:
-            print('script is exiting...')
-            raise SystemExit
-        if rawList.status_code != 200:
-            print('Error exiting script...')
-            print(rawList.text)
-            raise SystemExit
-        jsonDump = rawList.json()
+    while page <= pageCount and len(foundGroups) < len(names):
+        jsonDump = FetchPage(URL + "/ccgs?page=" + str(page) + "&limit=" + str(pageSize))
         for ccgObj in jsonDump['data']:
-            if ccgObj['name'] == ccgName:
-                ccgID = str(ccgObj['id'])
-                ccgMembersIDs = ccgObj['device_ids']
+            if ccgObj['name'] in missingNames and ccgObj['name'] not in foundGroups:
+                foundGroups[ccgObj['name']] = CcgGroup(ccgObj['name'], str(ccgObj['id']), ccgObj['device_ids'])
         pageCount = jsonDump['total_pages']
-        print(f"{colorOrange}Searching page {page} of {jsonDump['total_pages']} for \"" + ccgName + "\" CCG")
+        print(f"{colorOrange}Searching page {page} of {jsonDump['total_pages']} for " + CcgLabel(missingNames))
         page = jsonDump['page'] +1
-    if ccgID == '':
-        print(f'{colorRed}\n*** CCG - "' + ccgName + '" not found... refer to README for CCG requirement***')
+    if len(foundGroups) < len(names):
+        WriteCcgIdCache()  #drops the stale IDs
+        for name in names:
+            if name not in foundGroups:
+                print(f'{colorRed}\n*** CCG - "' + name + '" not found... refer to README for CCG requirement***')
         raise SystemExit
-    return ccgMembersIDs,ccgID
+    for name in missingNames:
+        ccgIdCache[name] = foundGroups[name].ccgID
+    WriteCcgIdCache()
+    return [foundGroups[name] for name in names]
 
-#Execute action when the device is Online and a member of the CCG
-def UpdateCcgTaggedDeviceDelta(deviceHostnameListLocal,deviceIDsListLocal):
-    if readOnlyMode != 'ENABLE':
-        print(f'\n{colorRed}Updating online device(s) "' + ', '.join(str(e) for e in (deviceHostnameListLocal)) + '" and removing from "' + ccgName + '" CCG')
-        url = URL + "/deployments"
-        payload = json.dumps({
-        "devices": {
-            "ids": 
-            deviceIDsListLocal
+##Submit one chunk of device IDs to /deployments, returns (True, '') or (False, error message)
+def SubmitDeploymentChunk(deviceIDsChunk):
+    url = URL + "/deployments"
+    payload = json.dumps({
+    "devices": {
+        "ids": 
+        deviceIDsChunk
+    },
+    "policy": {
+        "enable_complete_configuration_update": False,
+        "firmware_upgrade_policy": {
+        "enable_enforce_upgrade": False,
+        "enable_distributed_upgrade": False
         },
-        "policy": {
-            "enable_complete_configuration_update": False,
-            "firmware_upgrade_policy": {
-            "enable_enforce_upgrade": False,
-            "enable_distributed_upgrade": False
-            },
-            "firmware_activate_option": {
-            "enable_activate_at_next_reboot": False,
-            "activation_delay_seconds": 0,
-            "activation_time": 0
-            }
+        "firmware_activate_option": {
+        "enable_activate_at_next_reboot": False,
+        "activation_delay_seconds": 0,
+        "activation_time": 0
         }
-        })
-        response = requests.request("POST", url, headers=headers, data=payload)
-        if response is None:
-            log_msg = "ERROR: POST call to send Delta update - no response!"
-            print(f'{colorRed}{log_msg}')
-        if response.status_code != 200:
-            log_msg = f"Error - HTTP Status Code: {str(response.status_code)}"
-            try:
-                data = response.json()
-                if "error_message" in data:
-                    log_msg += f"\n\t{data['error_message']}"
-            except:
-                log_msg += ""
-            print(f'{colorRed}{log_msg}')
+    }
+    })
+    try:
+        response = XiqRequest("POST", url, data=payload)
+    except Exception as e:
+        return False,f"ERROR: POST call to send Delta update failed - {e}"
+    if response is None:
+        return False,"ERROR: POST call to send Delta update - no response!"
+    if response.status_code != 200:
+        log_msg = f"Error - HTTP Status Code: {str(response.status_code)}"
+        try:
+            data = response.json()
+            if "error_message" in data:
+                log_msg += f"\n\t{data['error_message']}"
+        except:
+            log_msg += ""
+        return False,log_msg
+    return True,''
+
+#Execute action when the device is Online and a member of the CCG.  Device IDs are sent in chunks of deploymentChunkSize with at most
+#deploymentMaxInFlight requests at a time; returns the device IDs of the chunks that were accepted.
+@TimedPhase('deployments')
+def UpdateCcgTaggedDeviceDelta(deviceHostnameListLocal,deviceIDsListLocal,ccgNameLocal):
+    deployedDeviceIDs = []
+    if readOnlyMode != 'ENABLE':
+        print(f'\n{colorRed}Updating online device(s) "' + ', '.join(str(e) for e in (deviceHostnameListLocal)) + '" and removing from "' + ccgNameLocal + '" CCG')
+        chunkSize = max(1, deploymentChunkSize)
+        chunks = [deviceIDsListLocal[start:start + chunkSize] for start in range(0, len(deviceIDsListLocal), chunkSize)]
+        if len(chunks) == 1:
+            results = [SubmitDeploymentChunk(chunks[0])]
         else:
-            print(f'{colorWhite}Update Device API executed successfully!')
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=max(1, min(deploymentMaxInFlight, len(chunks)))) as executor:
+                results = list(executor.map(SubmitDeploymentChunk, chunks))
+        for chunkNumber, (chunk, (deployed, log_msg)) in enumerate(zip(chunks, results), start=1):
+            chunkLabel = '' if len(chunks) == 1 else f'Chunk {chunkNumber} of {len(chunks)} ({len(chunk)} devices): '
+            if deployed:
+                deployedDeviceIDs.extend(chunk)
+                print(f'{colorWhite}{chunkLabel}Update Device API executed successfully!')
+            else:
+                print(f'{colorRed}{chunkLabel}{log_msg}')
+        CountMetric('deployed', len(deployedDeviceIDs))
+        if len(deployedDeviceIDs) != len(deviceIDsListLocal):
+            print(f'{colorRed}{len(deviceIDsListLocal) - len(deployedDeviceIDs)} of {len(deviceIDsListLocal)} device(s) were not deployed and stay in the "' + ccgNameLocal + '" CCG')
+    return deployedDeviceIDs
 
-##Updates CCG (ccgName) by removing Updated Device IDs
-def UpdateCCG(updatedDeviceIDs,ccgMembersIDs,ccgID):
+##Updates a CCG by removing Updated Device IDs
+@TimedPhase('ccg_update')
+def UpdateCCG(updatedDeviceIDs,ccgMembersIDs,ccgID,ccgNameLocal):
     if readOnlyMode != 'ENABLE':
-        for item in updatedDeviceIDs:
-            if item in ccgMembersIDs:
-                ccgMembersIDs.remove(item)
+        ccgMembersIDs.RemoveIds(updatedDeviceIDs)
         url = URL + "/ccgs/" + ccgID
         payload = json.dumps({
-        "name": ccgName,
+        "name": ccgNameLocal,
         "description": 'Update Offline Devices CCG used by a Python script',
-        "device_ids": ccgMembersIDs
+        "device_ids": ccgMembersIDs.ToList()
         })
-        response = requests.request("PUT", url, headers=headers, data=payload)
+        try:
+            response = XiqRequest("PUT", url, data=payload)
+        except Exception as e:
+            print(f'{colorRed}ERROR: PUT call to update the "{ccgNameLocal}" CCG failed - {e}')
+            return
         if response is None:
             log_msg = f"Error getting access token - HTTP Status Code: {str(response.status_code)}"
             print(f'{colorRed}{log_msg}')
@@ -397,8 +1861,19 @@ def UpdateCCG(updatedDeviceIDs,ccgMembersIDs,ccgID):
         else:
             print(f'{colorWhite}Update CCG API executed successfully!')
 
-##This is the start of the program
-def main():
+##Authentication option 2:  ask for the XIQ username/password when no token or username is set.  Only main() calls this, so loading
+##the script (email sender, tenant workers, benchmarks) never waits on a prompt.
+def PromptForCredentials():
+    global XIQ_username, XIQ_password, credentialsPrompted
+    if XIQ_Token or XIQ_username:
+        return
+    print ("Enter your XIQ login credentials ")
+    XIQ_username = input("Email: ")
+    XIQ_password = getpass.getpass("Password: ")
+    credentialsPrompted = True
+
+##Use the static token or generate one from the provided credentials
+def AuthenticateXiq():
     ##Test if a token is provided.  If not, use credentials.
     if not XIQ_Token:
         try:
@@ -412,25 +1887,98 @@ def main():
             raise SystemExit
     else:
         headers["Authorization"] = "Bearer " + XIQ_Token
-    if readOnlyMode == 'ENABLE':
-        print(f'\n{colorWhite}***Script is in READ ONLY mode*** Devices will not be updated.\n')
-    else:
-        print('\n')
-    ccgMembersIDs,ccgID = LocateCcgMemberIds()
-    deviceOnlineList,updatedDeviceIDs,updatedDeviceHostnames = GetDeviceOnlineList(ccgMembersIDs)
+
+##Deploy the online CCG members with a mismatch, then remove the deployed ones from the CCGs.  The CCG PUTs must follow the deployments.
+##Each CCG deploys its own members; a device in several CCGs is deployed once with the first of them and removed from all of them.
+##Returns the hostnames of the devices that were deployed.
+def DeployOnlineMismatches(updatedDeviceIDs,updatedDeviceHostnames,ccgGroups):
     if updatedDeviceIDs != []:
-        UpdateCCG(updatedDeviceIDs,ccgMembersIDs,ccgID)
-    deviceOfflineList = GetDeviceOfflineList(ccgMembersIDs)
+        deployedIDs = set()
+        assignedIDs = set()
+        for group in ccgGroups:
+            groupDevices = [(deviceId,hostname) for deviceId,hostname in zip(updatedDeviceIDs,updatedDeviceHostnames)
+                            if deviceId in group.members and deviceId not in assignedIDs]
+            if groupDevices:
+                groupIDs = [deviceId for deviceId,hostname in groupDevices]
+                assignedIDs.update(groupIDs)
+                deployedIDs.update(UpdateCcgTaggedDeviceDelta([hostname for deviceId,hostname in groupDevices],groupIDs,group.name))
+        for group in ccgGroups:
+            groupDeployedIDs = [deviceId for deviceId in updatedDeviceIDs if deviceId in deployedIDs and deviceId in group.members]
+            if groupDeployedIDs != []:
+                UpdateCCG(groupDeployedIDs,group.members,group.ccgID,group.name)
+        return [hostname for deviceId,hostname in zip(updatedDeviceIDs,updatedDeviceHostnames) if deviceId in deployedIDs]
+    elif readOnlyMode == 'ENABLE':
+        print(f"\n{colorGreen}Read-Only mode: no devices are deployed and the CCGs are not changed")
+        return []
+    else:
+        print(f"\n{colorGreen}No online devices found with an audit mismatch and member of the CCG")
+        return []
+
+##Run the audit phases one after another: CCG lookup > online sweep > deployment > CCG PUT > offline sweep
+##With ccgTargetedQuery the CCG members are queried and deployed first and the full sweeps only run when the report is due.
+##Returns None when the full report was skipped.
+def RunAuditPhases(reportSink):
+    ccgGroups = LocateCcgGroups()
+    if ccgTargetedQuery == 'ENABLE':
+        reportCcgGroups = [group.Copy() for group in ccgGroups]  #membership as it was before UpdateCCG, so the report matches a full sweep run
+        updatedDeviceIDs,updatedDeviceHostnames = GetCcgMemberMismatches(ccgGroups)
+        updatedDeviceHostnames = DeployOnlineMismatches(updatedDeviceIDs,updatedDeviceHostnames,ccgGroups)
+        if not FullReportDue():
+            return None
+        onlineHostnames = GetDeviceOnlineList(reportCcgGroups, reportSink)[0]
+    else:
+        onlineHostnames,updatedDeviceIDs,updatedDeviceHostnames = GetDeviceOnlineList(ccgGroups, reportSink)
+        updatedDeviceHostnames = DeployOnlineMismatches(updatedDeviceIDs,updatedDeviceHostnames,ccgGroups)
+    offlineHostnames = GetDeviceOfflineList(ccgGroups, reportSink)
+    return onlineHostnames,offlineHostnames,updatedDeviceHostnames
+
+##Run the audit phases as asyncio tasks (asyncMode).  Only the CCG lookup gates both sweeps; the offline sweep runs alongside
+##the online sweep > deployment > CCG PUT chain, so wall time is roughly the longer of the two chains.
+##With ccgTargetedQuery the update chain is the targeted query > deployment > CCG PUT and both report sweeps run alongside it.
+async def RunAuditPhasesAsync(reportSink):
+    import asyncio
+    ccgGroups = await asyncio.to_thread(LocateCcgGroups)
+    reportCcgGroups = [group.Copy() for group in ccgGroups]  #UpdateCCG edits the member indexes in place, the report sweeps read their own copy
+    fullReport = FullReportDue()
+
+    async def UpdateChain():
+        if ccgTargetedQuery == 'ENABLE':
+            onlineHostnames = None
+            updatedDeviceIDs,updatedDeviceHostnames = await asyncio.to_thread(GetCcgMemberMismatches, ccgGroups)
+        else:
+            onlineHostnames,updatedDeviceIDs,updatedDeviceHostnames = await asyncio.to_thread(GetDeviceOnlineList, ccgGroups, reportSink)
+        updatedDeviceHostnames = await asyncio.to_thread(DeployOnlineMismatches, updatedDeviceIDs, updatedDeviceHostnames, ccgGroups)
+        return onlineHostnames,updatedDeviceHostnames
+
+    updateTask = asyncio.create_task(UpdateChain())
+    onlineTask = None
+    offlineTask = None
+    if fullReport:
+        if ccgTargetedQuery == 'ENABLE':
+            onlineTask = asyncio.create_task(asyncio.to_thread(GetDeviceOnlineList, reportCcgGroups, reportSink))
+        offlineTask = asyncio.create_task(asyncio.to_thread(GetDeviceOfflineList, reportCcgGroups, reportSink))
+    onlineHostnames,updatedDeviceHostnames = await updateTask
+    if not fullReport:
+        return None
+    if onlineTask is not None:
+        onlineHostnames = (await onlineTask)[0]
+    offlineHostnames = await offlineTask
+    return onlineHostnames,offlineHostnames,updatedDeviceHostnames
+
+##Print the report, write the CSV and send the email.  With a snapshot only the changes are reported and nothing is rewritten
+##or emailed when no device was added, removed or changed.  Returns the snapshot to commit once the report is out, None when
+##there is none or the email could not be queued, so the next run reports the same changes again.
+def WriteReport(onlineHostnames,offlineHostnames,updatedDeviceHostnames,reportWriter,deviceSnapshot=None):
     print(f'\n{colorWhite}---------- REPORT ----------')
-    msg1 = ('\nTotal Number Devices Found: Real / Connected / Audit Mismatch Is True = ' + str(len(deviceOnlineList)))
-    if len(deviceOnlineList) > 0:
-        msg2 = ('Devices: ' + ', '.join(str(e['HOSTNAME']) for e in (deviceOnlineList)))
+    msg1 = ('\nTotal Number Devices Found: Real / Connected / Audit Mismatch Is True = ' + str(len(onlineHostnames)))
+    if len(onlineHostnames) > 0:
+        msg2 = ('Devices: ' + ', '.join(str(e) for e in (onlineHostnames)))
     else:
         msg2 = ('No devices found that meet the criteria above.')
     print(f'{colorGreen}' + msg1 + '\n' + msg2)
-    msg3 = (f'\nTotal Number Devices Found: Real / Disconnected = ' + str(len(deviceOfflineList)))
-    if len(deviceOfflineList) > 0:
-        msg4 = ('Devices: ' + ', '.join(str(e['HOSTNAME']) for e in (deviceOfflineList)))
+    msg3 = (f'\nTotal Number Devices Found: Real / Disconnected = ' + str(len(offlineHostnames)))
+    if len(offlineHostnames) > 0:
+        msg4 = ('Devices: ' + ', '.join(str(e) for e in (offlineHostnames)))
     else:
         msg4 = ('No devices found that meet the criteria above.')
     print(f'{colorGrey}' + msg3 + '\n' + msg4)
@@ -443,19 +1991,28 @@ def main():
             msg5 = 'Updated device list: ' + ', '.join(updatedDeviceHostnames)
         print(f'\n{colorGreen}' + msg5)
         email_msg = msg1 + '\n' + msg2 + '\n' + msg3 + '\n' + msg4 + '\n\n' + msg5
+    if deviceSnapshot is not None:
+        delta = deviceSnapshot.Diff()
+        if not deviceSnapshot.hasBaseline:
+            print(f'\n{colorCyan}No previous snapshot found, recording {len(delta["added"])} devices in "' + snapshotFile + '"')
+        elif not (delta['added'] or delta['removed'] or delta['changed']):
+            print(f'\n{colorCyan}No devices added, removed or changed since the last run.  "' + filename + '" is unchanged and no email is sent.\n')
+            return deviceSnapshot
+        else:
+            email_msg += '\n\n' + '\n'.join(WriteDeltaReport(delta, reportWriter.columns))
     print(f'\n{colorPurple}Populating CSV file with found devices: "' + filename + '" <-- Check script directory for file.\n')
-    allDevices = deviceOnlineList + deviceOfflineList
-    dfAllDevices = pd.DataFrame(allDevices)
-    if len(allDevices) != 0:
-        dfAllDevices.sort_values(by=['HOSTNAME'], inplace=True, ascending=True)  #sort rows by Hostname
-    dfAllDevices.to_csv(filename, index=False)
+    with MetricsPhase('csv_write'):
+        reportWriter.Close()  #rows are sorted by Hostname
     if smtp_server != '' and emailFeature == 'ENABLE':
-        if len(deviceOnlineList) != 0:
+        if len(onlineHostnames) != 0:
             try:
-                SendMail(sender_email, tolist, email_msg, email_subject, smtp_server, smtp_port, filename)
-            except TypeError as e:
-                print(e)
-            print(f'{colorWhite}Email includes CSV and sent to: ' + ','.join(str(e) for e in (tolist)) + '\n')
+                QueueMail(sender_email, tolist, email_msg, email_subject, smtp_server, smtp_port, filename)
+            except OSError as e:
+                print(f'{colorRed}Unable to queue the email in "{outboxDir}": {e}\n')
+                return None
+            else:
+                print(f'{colorWhite}Email with the zipped CSV queued in "{outboxDir}" for: ' + ','.join(str(e) for e in (tolist)) + '\n')
+                StartOutboxSender()
         else:
             print(f'{colorWhite}No email was sent due to all online devices having current configurations. Check CSV for offline devices. \n')
     elif emailFeature != 'ENABLE':
@@ -464,6 +2021,221 @@ def main():
         print(f'{colorWhite}No SMTP server defined, skipping email. \n')
     else:
         print(f'{colorRed}Unknown issue... Verify all User Settings Section variables: smtp_server, emailFeature, etc.')
+    return deviceSnapshot
+
+##One complete audit: sweeps, deployment, CCG update, report and email
+def RunAuditCycle():
+    global runMetrics, sweepCheckpoint
+    ResetProjectionStats()
+    runMetrics = RunMetrics() if metricsFeature == 'ENABLE' else None
+    sweepCheckpoint = OpenSweepCheckpoint() if checkpointFeature == 'ENABLE' else None
+    runStatus = 'failed'
+    if readOnlyMode == 'ENABLE':
+        print(f'\n{colorWhite}***Script is in READ ONLY mode*** Devices will not be updated.\n')
+    else:
+        print('\n')
+    reportWriter = ReportWriter(filename, ReportColumns())
+    deviceSnapshot = DeviceSnapshot(os.path.join(PATH, snapshotFile), ReportColumns()) if snapshotFeature == 'ENABLE' else None
+    columnarWriter = CreateColumnarWriter()
+    reportSink = ReportSinks([reportWriter, deviceSnapshot, columnarWriter])
+    try:
+        if asyncMode == 'ENABLE':
+            import asyncio
+            auditResults = asyncio.run(RunAuditPhasesAsync(reportSink))
+        else:
+            auditResults = RunAuditPhases(reportSink)
+        if auditResults is None:
+            print(f'\n{colorWhite}Full fleet report is not due yet (fullReportIntervalMinutes = {fullReportIntervalMinutes}), skipping sweeps, CSV and email.\n')
+        else:
+            onlineHostnames,offlineHostnames,updatedDeviceHostnames = auditResults
+            if activeProfile is not None:
+                activeProfile.Snapshot('the end of the device sweeps')  #every record is buffered, usually the memory high point
+            reportedSnapshot = WriteReport(onlineHostnames,offlineHostnames,updatedDeviceHostnames,reportWriter,deviceSnapshot)
+            if columnarWriter is not None:
+                with MetricsPhase('columnar_write'):
+                    columnarWriter.Close()  #every full run goes to the history, even when the snapshot found no changes
+            if reportedSnapshot is not None:
+                reportedSnapshot.Commit()  #after the CSV and the email, a run that fails before this reports the same changes again
+            MarkFullReport()
+        runStatus = 'ok' if auditResults is not None else 'not_due'
+    finally:
+        if sweepCheckpoint is not None:
+            sweepCheckpoint.Close(runStatus == 'ok')
+            sweepCheckpoint = None
+        reportWriter.Discard()  #removes any spill files left behind by an aborted run
+        if columnarWriter is not None:
+            columnarWriter.Discard()
+        if deviceSnapshot is not None:
+            deviceSnapshot.Close()
+        if runMetrics is not None:
+            metrics = runMetrics
+            runMetrics = None
+            WriteRunMetrics(metrics, runStatus)  #a failed run is recorded too, with xiq_audit_last_run_success 0
+    PrintProjectionStats()
+    PrintPoolStats()
+    PrintRateLimiterStats()
+    return auditResults
+
+##Repeat the audit every watchIntervalSeconds (watchMode).  Cycles run one after another in this process so they can never overlap;
+##a cycle that runs past its interval skips the missed start times instead of queueing them.
+def RunWatchLoop():
+    print(f'{colorWhite}Watch mode: running the audit every {watchIntervalSeconds} seconds.  Press Ctrl+C to stop.')
+    cycle = 0
+    nextStart = time.monotonic()
+    try:
+        while True:
+            cycle += 1
+            cycleStart = time.monotonic()
+            print(f'\n{colorWhite}========== Audit cycle {cycle} started ' + time.strftime('%Y-%m-%d %H:%M:%S') + ' ==========')
+            try:
+                RunAuditCycle()
+            except SystemExit:
+                print(f'{colorRed}Audit cycle {cycle} failed, trying again at the next interval')
+            except Exception as e:
+                print(f'{colorRed}Audit cycle {cycle} failed with an unexpected error: {e!r}, trying again at the next interval')
+            nextStart += watchIntervalSeconds
+            now = time.monotonic()
+            if now > nextStart:
+                missed = int((now - nextStart) // watchIntervalSeconds) + 1
+                print(f'{colorOrange}Audit cycle {cycle} took {now - cycleStart:.0f} seconds, longer than watchIntervalSeconds.  Skipping {missed} start time(s).')
+                nextStart += missed * watchIntervalSeconds
+            time.sleep(max(0, nextStart - time.monotonic()))
+    except KeyboardInterrupt:
+        print(f'\n{colorWhite}Watch mode stopped after {cycle} audit cycle(s).')
+
+##Multi-tenant mode (tenantMode)-----------------------------------------------------------------------------------------------------
+##Read and check tenantConfigFile.  Tenants may only override existing user settings so a typo cannot silently fall back to the defaults.
+def LoadTenantConfig():
+    try:
+        with open(os.path.join(PATH, tenantConfigFile)) as configFile:
+            tenants = json.load(configFile)
+    except OSError as e:
+        print(f'{colorRed}Unable to read tenant config "{tenantConfigFile}": {e}')
+        raise SystemExit
+    except ValueError as e:
+        print(f'{colorRed}Tenant config "{tenantConfigFile}" is not valid JSON: {e}')
+        raise SystemExit
+    if not isinstance(tenants, list) or not tenants:
+        print(f'{colorRed}Tenant config "{tenantConfigFile}" must be a JSON list with at least one tenant')
+        raise SystemExit
+    settings = {key for key, value in globals().items() if not key.startswith('_') and isinstance(value, (str, int, float, list))}
+    tags = set()
+    for tenant in tenants:
+        if not isinstance(tenant, dict) or not tenant.get('name'):
+            print(f'{colorRed}Every tenant in "{tenantConfigFile}" needs a "name": {tenant}')
+            raise SystemExit
+        tag = TenantFileTag(tenant['name'])
+        if tag in tags:
+            print(f'{colorRed}Tenant name "{tenant["name"]}" is used more than once in "{tenantConfigFile}"')
+            raise SystemExit
+        tags.add(tag)
+        unknown = [key for key in tenant if key != 'name' and key not in settings]
+        if unknown:
+            print(f'{colorRed}Tenant "{tenant["name"]}" has unknown settings: ' + ', '.join(unknown))
+            raise SystemExit
+        if not tenant.get('XIQ_Token', XIQ_Token) and not tenant.get('XIQ_username', XIQ_username):
+            print(f'{colorRed}Tenant "{tenant["name"]}" has no XIQ_Token or XIQ_username/XIQ_password.  Tenant workers cannot prompt for credentials '
+                  '(authentication option 2), set them in "' + tenantConfigFile + '"')
+            raise SystemExit
+    return tenants
+
+##Tenant name made safe for file names
+def TenantFileTag(tenantName):
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in str(tenantName))
+
+##Runs in a fresh worker process:  apply the tenant settings, give every output file a tenant suffix and run one audit with the
+##screen output going to the tenant log.  Returns one summary line for the consolidated report.
+def RunTenantAudit(tenant):
+    global filename, fullReportStampFile, snapshotFile, tokenCacheFile, ccgCacheFile, checkpointFile, changesFilename, columnarHistoryDir, outboxDir, metricsPromFile, metricsJsonFile, watchMode, tenantMode, tenantName
+    import contextlib
+    startTime = time.monotonic()
+    tag = TenantFileTag(tenant['name'])
+    globals().update({key: value for key, value in tenant.items() if key != 'name'})
+    filename = f'device-list-{tag}.csv'
+    fullReportStampFile = f'.xiq-full-report-{tag}'
+    snapshotFile = f'device-snapshot-{tag}.db'
+    tokenCacheFile = f'.xiq-token-cache-{tag}.json'
+    ccgCacheFile = f'.xiq-ccg-cache-{tag}.json'
+    checkpointFile = f'.xiq-sweep-checkpoint-{tag}.jsonl'
+    columnarHistoryDir = os.path.join(columnarHistoryDir, f'tenant={tag}')
+    outboxDir = os.path.join(outboxDir, f'tenant={tag}')
+    changesFilename = f'device-list-changes-{tag}.csv'
+    watchMode = tenantMode = 'DISABLE'
+    promRoot,promExtension = os.path.splitext(metricsPromFile)
+    metricsPromFile = f'{promRoot}_{tag}{promExtension}'
+    jsonRoot,jsonExtension = os.path.splitext(metricsJsonFile)
+    metricsJsonFile = f'{jsonRoot}-{tag}{jsonExtension}'
+    tenantName = tenant['name']
+    summary = {'tenant': tenant['name'], 'status': 'OK', 'online': '', 'offline': '', 'updated': '', 'report': filename, 'log': f'tenant-{tag}.log'}
+    with open(summary['log'], 'w') as tenantLog, contextlib.redirect_stdout(tenantLog):
+        StartProfiling()  #each worker profiles its own tenant, the parent process only waits
+        try:
+            AuthenticateXiq()
+            auditResults = RunAuditCycle()
+            if auditResults is None:
+                summary.update({'status': 'NOT DUE', 'report': ''})
+            else:
+                onlineHostnames,offlineHostnames,updatedDeviceHostnames = auditResults
+                summary.update({'online': len(onlineHostnames), 'offline': len(offlineHostnames), 'updated': len(updatedDeviceHostnames)})
+        except SystemExit:
+            summary.update({'status': 'FAILED', 'report': ''})
+        except Exception as e:
+            print(f'{colorRed}Unexpected error: {e!r}')
+            summary.update({'status': 'FAILED', 'report': ''})
+        finally:
+            StopProfiling()
+    summary['seconds'] = round(time.monotonic() - startTime, 1)
+    return summary
+
+##Audit every tenant in tenantConfigFile with up to tenantWorkers worker processes.  Each worker process audits a single tenant and
+##exits (max_tasks_per_child=1) so no tenant inherits the globals, token or HTTP session of another.
+def RunTenantAudits():
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    tenants = LoadTenantConfig()
+    workers = max(1, min(tenantWorkers, len(tenants)))
+    print(f'{colorWhite}Multi-tenant mode: auditing {len(tenants)} tenant(s) from "{tenantConfigFile}" with {workers} worker process(es)\n')
+    startTime = time.monotonic()
+    summaries = {}
+    with ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1) as pool:
+        futures = {pool.submit(RunTenantAudit, tenant): tenant['name'] for tenant in tenants}
+        for future in as_completed(futures):
+            tenantName = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                summary = {'tenant': tenantName, 'status': 'FAILED', 'online': '', 'offline': '', 'updated': '', 'report': '', 'log': '', 'seconds': ''}
+                print(f'{colorRed}Tenant "{tenantName}" worker process failed: {e!r}')
+            summaries[tenantName] = summary
+            statusColor = colorGreen if summary['status'] == 'OK' else colorRed if summary['status'] == 'FAILED' else colorWhite
+            counts = f":  online mismatch {summary['online']}, offline {summary['offline']}, updated {summary['updated']}" if summary['status'] == 'OK' else ''
+            print(f"{statusColor}Tenant \"{tenantName}\" {summary['status']} in {summary['seconds']} s{counts}  (log: {summary['log']})")
+    with open(tenantSummaryFile, 'w', newline='') as summaryOut:
+        writer = csv.writer(summaryOut, lineterminator=os.linesep)
+        writer.writerow(['TENANT', 'STATUS', 'ONLINE MISMATCH', 'OFFLINE', 'UPDATED', 'SECONDS', 'REPORT', 'LOG'])
+        for tenant in tenants:
+            summary = summaries[tenant['name']]
+            writer.writerow([summary[key] for key in ('tenant', 'status', 'online', 'offline', 'updated', 'seconds', 'report', 'log')])
+    print(f'\n{colorPurple}{len(tenants)} tenant(s) audited in {time.monotonic() - startTime:.1f} s.  Summary written to "' + tenantSummaryFile + '"\n')
+##end Multi-tenant mode-------------------------------------------------------------------------------------------------------------
+
+##This is the start of the program
+def main():
+    if '--drain-outbox' in sys.argv[1:]:
+        DrainOutbox()
+        return
+    if tenantMode == 'ENABLE':
+        RunTenantAudits()
+        return
+    PromptForCredentials()
+    StartProfiling()
+    try:
+        AuthenticateXiq()
+        if watchMode == 'ENABLE':
+            RunWatchLoop()
+        else:
+            RunAuditCycle()
+    finally:
+        StopProfiling()  #a failed run is profiled too
         
 ##Python will see this and run whatever function is provided: xxxxxx(), should be the last items in this file
 if __name__ == '__main__':
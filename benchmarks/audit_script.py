@@ -0,0 +1,24 @@
+import importlib.util
+import os
+
+##Loads XIQ-Audit-Mismatch-Alerts_v2a.py as a module (the hyphenated file name cannot be imported directly)
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'XIQ-Audit-Mismatch-Alerts_v2a.py')
+
+def LoadAuditScript(moduleName='xiq_audit'):
+    spec = importlib.util.spec_from_file_location(moduleName, SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+##Apply KEY=VALUE overrides to the script's user settings.  Numbers and lists are parsed as Python literals, anything else is a string.
+def ApplySettings(module, settings):
+    import ast
+    for item in settings or []:
+        key, _, value = item.partition('=')
+        if not hasattr(module, key):
+            raise SystemExit(f'Unknown setting: {key}')
+        try:
+            parsed = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            parsed = value
+        setattr(module, key, parsed)
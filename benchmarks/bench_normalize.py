@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+import time
+from urllib.parse import parse_qs
+
+########################################################################################################################
+## Normalizer benchmark:  time to turn /devices pages into report records with the shared column-wise NormalizeDevicePage of
+## XIQ-Audit-Mismatch-Alerts_v2a.py versus the per-device branch loops the Online/Offline sweeps used before it.
+## Each sweep gets the pages its /devices filter returns from a mock fleet of --devices devices, decoded from JSON like real
+## responses and built once before timing.  Both ways must produce the same CSV values, otherwise the benchmark fails.
+########################################################################################################################
+## Examples:
+##   python3 benchmarks/bench_normalize.py
+##   python3 benchmarks/bench_normalize.py --devices 100000 --repeat 5 --ccgs 3
+########################################################################################################################
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the device normalizer of the XIQ audit sweeps')
+    parser.add_argument('--devices', type=int, default=100000, help='mock fleet size, split between the two sweeps')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per sweep, the best one is reported')
+    parser.add_argument('--ccgs', type=int, default=1, help='number of update CCGs (one CSV column each)')
+    return parser.parse_args(argv)
+
+##DeviceRecord interned these values in its constructor before NormalizeDevicePage did it per column
+def Intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+##The Online sweep loop before NormalizeDevicePage, kept here as the baseline
+def LegacyOnlinePage(audit, devices, ccgGroups):
+    pageRecords = []
+    for device in devices:
+        if device['device_function']:
+            deviceType = device['device_function']
+        else:
+            deviceType = 'Unknown'
+        if device['locations']:
+            building = device['locations'][-2]['name']
+            floor = device['locations'][-1]['name']
+        else:
+            building = 'No Location'
+            floor = 'No Floor'
+        flags = tuple(['Yes' if device['id'] in group.members else 'No' for group in ccgGroups])
+        ccgFlags = audit.ccgFlagTuples.setdefault(flags, flags)
+        if 'Yes' in ccgFlags:
+            if audit.readOnlyMode != 'ENABLE':
+                updated = 'Yes'
+            else:
+                updated = 'Read-Only'
+        else:
+            updated = 'Not in CCG'
+        if device['software_version']:
+            software = device['software_version']
+        else:
+            software = 'Unknown'
+        if device['ip_address']:
+            ip = device['ip_address']
+        else:
+            ip = 'Unknown'
+        if device['network_policy_name']:
+            policy = device['network_policy_name']
+        else:
+            policy = 'Unknown'
+        if device['product_type']:
+            model = device['product_type']
+        else:
+            model = 'Unknown'
+        pageRecords.append(audit.DeviceRecord(device['hostname'], Intern(deviceType), 'Online', 'Mismatch', Intern(building), Intern(floor), ccgFlags, updated,
+                                              Intern(software), ip, Intern(policy), Intern(model), 'Now', device['id']))
+    return pageRecords
+
+##The Offline sweep loop before NormalizeDevicePage, kept here as the baseline
+def LegacyOfflinePage(audit, devices, ccgGroups):
+    pageRecords = []
+    for device in devices:
+        if 'device_function' in device and device['device_function']:
+            deviceType = device['device_function']
+        else:
+            deviceType = 'Unknown'
+        if device['locations']:
+            building = device['locations'][-2]['name']
+            floor = device['locations'][-1]['name']
+        else:
+            building = 'No Location'
+            floor = 'No Floor'
+        if device['software_version']:
+            software = device['software_version']
+        else:
+            software = 'Unknown'
+        if 'ip_address' in device and device['ip_address']:
+            ip = device['ip_address']
+        else:
+            ip = 'Unknown'
+        if device['network_policy_name']:
+            policy = device['network_policy_name']
+        else:
+            policy = 'Unknown'
+        if device['product_type']:
+            model = device['product_type']
+        else:
+            model = 'Unknown'
+        if 'last_connect_time' in device and device['last_connect_time']:
+            lastSeen = device['last_connect_time']
+        else:
+            lastSeen = 'Check if device has ever connected to XIQ'
+        flags = tuple(['Yes' if device['id'] in group.members else 'No' for group in ccgGroups])
+        pageRecords.append(audit.DeviceRecord(device['hostname'], Intern(deviceType), 'Offline', 'Unknown', Intern(building), Intern(floor),
+                                              audit.ccgFlagTuples.setdefault(flags, flags), 'N/A', Intern(software), ip, Intern(policy), Intern(model), lastSeen, device['id']))
+    return pageRecords
+
+##Best wall time of normalizing every page, plus the records of the last run
+def TimePages(normalize, pages, repeatCount):
+    best = None
+    for _ in range(max(1, repeatCount)):
+        start = time.perf_counter()
+        records = [record for page in pages for record in normalize(page)]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, records
+
+def main(argv=None):
+    args = ParseArgs(argv)
+    sys.path.insert(0, benchDir)
+    from audit_script import LoadAuditScript
+    from xiq_mock_server import MockFleet, baseDeviceId
+    audit = LoadAuditScript()
+    audit.readOnlyMode = 'DISABLE'
+    fleet = MockFleet(args.devices)
+    ccgGroups = [audit.CcgGroup(f'UpdateGroup{number}', str(number), range(baseDeviceId + number, baseDeviceId + args.devices, 50))
+                 for number in range(args.ccgs)]
+    sweeps = {
+        'Online': ("&connected=true&adminStates=MANAGED&deviceTypes=REAL&configMismatch=true",
+                   lambda page: LegacyOnlinePage(audit, page, ccgGroups),
+                   lambda page: audit.NormalizeDevicePage(page, 'Online', 'Mismatch', ccgGroups, 'Yes', 'Not in CCG', 'Now')),
+        'Offline': ("&connected=false&adminStates=MANAGED&deviceTypes=REAL",
+                    lambda page: LegacyOfflinePage(audit, page, ccgGroups),
+                    lambda page: audit.NormalizeDevicePage(page, 'Offline', 'Unknown', ccgGroups, 'N/A', 'N/A'))}
+    print(f"{'sweep':>8} {'devices':>9} {'loop s':>8} {'columns s':>10} {'devices/s':>11} {'speedup':>8}")
+    for sweep, (deviceFilters, legacy, shared) in sweeps.items():
+        indexes = fleet.MatchDevices(parse_qs(deviceFilters.lstrip('&')))
+        pages = [json.loads(json.dumps([fleet.BuildDevice(index) for index in indexes[start:start + audit.pageSize]]))
+                 for start in range(0, len(indexes), audit.pageSize)]
+        legacyTime, legacyRecords = TimePages(legacy, pages, args.repeat)
+        sharedTime, sharedRecords = TimePages(shared, pages, args.repeat)
+        if [record.Values() + [record.deviceId] for record in legacyRecords] != [record.Values() + [record.deviceId] for record in sharedRecords]:
+            raise SystemExit(f'FAIL: NormalizeDevicePage output differs from the {sweep} sweep loop')
+        print(f'{sweep:>8} {len(indexes):>9} {legacyTime:>8.3f} {sharedTime:>10.3f} {len(indexes) / sharedTime:>11.0f} {legacyTime / sharedTime:>7.2f}x')
+
+if __name__ == '__main__':
+    main()
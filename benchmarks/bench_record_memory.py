@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from urllib.parse import parse_qs
+
+########################################################################################################################
+## Record memory benchmark:  memory held by the report records of the Online/Offline sweeps at fleet scale, comparing the
+## slotted DeviceRecord the script builds today with the 14 key dict per device it used to build.
+## The sweeps of XIQ-Audit-Mismatch-Alerts_v2a.py run in-process on pages from the mock fleet (decoded from JSON like real
+## responses) and every record is kept, as if no CSV spill happened.  Each layout runs in a fresh interpreter.
+########################################################################################################################
+## Examples:
+##   python3 benchmarks/bench_record_memory.py
+##   python3 benchmarks/bench_record_memory.py --devices 10000 100000 --ccgs 3
+########################################################################################################################
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+layouts = ['dict', 'record']
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the memory of report records built by the device sweeps')
+    parser.add_argument('--devices', type=int, nargs='+', default=[100000], help='fleet sizes to measure')
+    parser.add_argument('--ccgs', type=int, default=1, help='number of update CCGs (one CSV column each)')
+    parser.add_argument('--child', choices=layouts, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+##Keeps every record a sweep produces
+class RetainSink:
+    def __init__(self):
+        self.rows = []
+
+    def AddRows(self, rows):
+        self.rows.extend(rows)
+
+##Pages the sweeps would receive from GET /devices, decoded from JSON so every string is a fresh object like a real response
+def MockDevicePages(fleet, pageSize):
+    def GetDevicePages(deviceFilters, pageColor, pageLabel, projectFields=None):
+        indexes = fleet.MatchDevices(parse_qs(deviceFilters.lstrip('&')))
+        for start in range(0, len(indexes), pageSize):
+            page = {'data': [fleet.BuildDevice(index) for index in indexes[start:start + pageSize]]}
+            yield json.loads(json.dumps(page))
+    return GetDevicePages
+
+##The per-device dict the sweeps built before DeviceRecord, kept here to measure the old layout
+def LegacyOnlineRows(jsonDump, ccgGroups, readOnlyMode):
+    pageRows = []
+    for device in jsonDump['data']:
+        newData = {}
+        newData['HOSTNAME'] = device['hostname']
+        newData['TYPE'] = device['device_function'] or 'Unknown'
+        newData['STATUS'] = 'Online'
+        newData['AUDIT FLAG'] = 'Mismatch'
+        if device['locations']:
+            newData['BUILDING'] = device['locations'][-2]['name']
+            newData['FLOOR'] = device['locations'][-1]['name']
+        else:
+            newData['BUILDING'] = 'No Location'
+            newData['FLOOR'] = 'No Floor'
+        inCcg = False
+        for group in ccgGroups:
+            if device['id'] in group.members:
+                newData['CCG-' + group.name] = 'Yes'
+                inCcg = True
+            else:
+                newData['CCG-' + group.name] = 'No'
+        if inCcg:
+            newData['UPDATED'] = 'Yes' if readOnlyMode != 'ENABLE' else 'Read-Only'
+        else:
+            newData['UPDATED'] = 'Not in CCG'
+        newData['SOFTWARE'] = device['software_version'] or 'Unknown'
+        newData['IP'] = device['ip_address'] or 'Unknown'
+        newData['POLICY'] = device['network_policy_name'] or 'Unknown'
+        newData['MODEL'] = device['product_type'] or 'Unknown'
+        newData['LAST SEEN'] = 'Now'
+        newData['DEVICE ID'] = device['id']
+        pageRows.append(newData)
+    return pageRows
+
+def LegacyOfflineRows(jsonDump, ccgGroups):
+    pageRows = []
+    for device in jsonDump['data']:
+        newData = {}
+        newData['HOSTNAME'] = device['hostname']
+        newData['TYPE'] = device.get('device_function') or 'Unknown'
+        newData['STATUS'] = 'Offline'
+        newData['AUDIT FLAG'] = 'Unknown'
+        if device['locations']:
+            newData['BUILDING'] = device['locations'][-2]['name']
+            newData['FLOOR'] = device['locations'][-1]['name']
+        else:
+            newData['BUILDING'] = 'No Location'
+            newData['FLOOR'] = 'No Floor'
+        for group in ccgGroups:
+            newData['CCG-' + group.name] = 'Yes' if device['id'] in group.members else 'No'
+        newData['UPDATED'] = 'N/A'
+        newData['SOFTWARE'] = device['software_version'] or 'Unknown'
+        newData['IP'] = device.get('ip_address') or 'Unknown'
+        newData['POLICY'] = device['network_policy_name'] or 'Unknown'
+        newData['MODEL'] = device['product_type'] or 'Unknown'
+        newData['LAST SEEN'] = device.get('last_connect_time') or 'Check if device has ever connected to XIQ'
+        newData['DEVICE ID'] = device['id']
+        pageRows.append(newData)
+    return pageRows
+
+##Runs inside the child interpreter:  sweep the whole fleet with one record layout and print the retained memory as JSON
+def RunChild(layout, deviceCount, ccgCount):
+    sys.path.insert(0, benchDir)
+    from audit_script import LoadAuditScript
+    from xiq_mock_server import MockFleet, baseDeviceId
+    audit = LoadAuditScript()
+    audit.readOnlyMode = 'DISABLE'
+    fleet = MockFleet(deviceCount)
+    ccgGroups = [audit.CcgGroup(f'UpdateGroup{number}', str(number), range(baseDeviceId + number, baseDeviceId + deviceCount, 50))
+                 for number in range(ccgCount)]
+    getDevicePages = MockDevicePages(fleet, audit.pageSize)
+    sink = RetainSink()
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    if layout == 'record':
+        audit.GetDevicePages = getDevicePages
+        audit.GetDeviceOnlineList(ccgGroups, sink)
+        audit.GetDeviceOfflineList(ccgGroups, sink)
+    else:
+        for jsonDump in getDevicePages("&connected=true&adminStates=MANAGED&deviceTypes=REAL&configMismatch=true", None, None):
+            sink.AddRows(LegacyOnlineRows(jsonDump, ccgGroups, audit.readOnlyMode))
+        for jsonDump in getDevicePages("&connected=false&adminStates=MANAGED&deviceTypes=REAL", None, None):
+            sink.AddRows(LegacyOfflineRows(jsonDump, ccgGroups))
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    print(json.dumps({'layout': layout, 'records': len(sink.rows), 'retained_bytes': retained, 'seconds': elapsed}))
+
+def MeasureLayout(layout, deviceCount, ccgCount):
+    command = [sys.executable, os.path.abspath(__file__), '--child', layout, '--devices', str(deviceCount), '--ccgs', str(ccgCount)]
+    child = subprocess.run(command, capture_output=True, text=True)
+    if child.returncode != 0:
+        raise SystemExit(f'Measuring the {layout} layout failed:\n{child.stderr}')
+    return json.loads(child.stdout.strip().splitlines()[-1])
+
+def main(argv=None):
+    args = ParseArgs(argv)
+    if args.child:
+        return RunChild(args.child, args.devices[0], args.ccgs)
+    print(f"{'devices':>9} {'records':>9} {'layout':>7} {'retained MB':>12} {'bytes/device':>13} {'sweep s':>8}")
+    for deviceCount in args.devices:
+        results = {layout: MeasureLayout(layout, deviceCount, args.ccgs) for layout in layouts}
+        for layout in layouts:
+            result = results[layout]
+            perDevice = result['retained_bytes'] / max(1, result['records'])
+            print(f"{deviceCount:>9} {result['records']:>9} {layout:>7} {result['retained_bytes'] / 1048576:>12.1f} {perDevice:>13.0f} {result['seconds']:>8.2f}")
+        saved = 1 - results['record']['retained_bytes'] / max(1, results['dict']['retained_bytes'])
+        print(f'{"":>9} DeviceRecord holds {saved:.0%} less memory than the per-device dict')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+########################################################################################################################
+## Scale benchmark:  runs the real audit (main() of XIQ-Audit-Mismatch-Alerts_v2a.py) against the local mock XIQ API
+## at several fleet sizes and reports wall time, API requests issued and peak memory for each run.
+## Every size uses a fresh mock server and a fresh interpreter so results do not leak between runs.
+########################################################################################################################
+## Examples:
+##   python3 benchmarks/bench_scale.py
+##   python3 benchmarks/bench_scale.py --sizes 1000 10000 --latency 0.05 --set parallelPagination=ENABLE --set asyncMode=ENABLE
+##   python3 benchmarks/bench_scale.py --json results.json
+########################################################################################################################
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the XIQ audit against the mock XIQ API')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='fleet sizes to run')
+    parser.add_argument('--latency', type=float, default=0.0, help='mock API latency in seconds per request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of mock API requests answered with an error')
+    parser.add_argument('--error-codes', default='500,502,503')
+    parser.add_argument('--set', dest='settings', action='append', default=[], metavar='KEY=VALUE',
+                        help='override a user setting of the script, e.g. --set parallelPagination=ENABLE (repeatable)')
+    parser.add_argument('--json', dest='jsonFile', help='also write the results to this JSON file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+##Runs inside the child interpreter:  execute one audit and print the measurements as JSON
+def RunChild(args):
+    sys.path.insert(0, benchDir)
+    from audit_script import ApplySettings, LoadAuditScript
+    audit = LoadAuditScript()
+    audit.URL = args.url
+    audit.PATH = os.getcwd()  #the child runs in the per-run temporary work directory, so reports, caches, snapshot, checkpoint and outbox stay out of the checkout
+    audit.readOnlyMode = 'DISABLE'  #the mock tenant is safe to update, so exercise the deployment and CCG PUT path too
+    ApplySettings(audit, args.settings)
+    status = 'ok'
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            audit.main()
+        except SystemExit:
+            status = 'exited'
+    wallTime = time.perf_counter() - start
+    try:
+        import resource
+        peakKb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peakMb = peakKb / 1024 if sys.platform != 'darwin' else peakKb / (1024 * 1024)
+    except ImportError:
+        peakMb = None
+    print(json.dumps({'status': status, 'wall_time': wallTime, 'peak_rss_mb': peakMb}))
+
+def StartMockServer(size, args):
+    command = [sys.executable, os.path.join(benchDir, 'xiq_mock_server.py'), '--port', '0', '--devices', str(size),
+               '--latency', str(args.latency), '--error-rate', str(args.error_rate), '--error-codes', args.error_codes]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    banner = server.stdout.readline()
+    match = re.search(r'(http://\S+)', banner)
+    if not match:
+        server.kill()
+        raise SystemExit(f'Mock server did not start: {banner!r}')
+    return server, match.group(1)
+
+def GetJson(url):
+    with urllib.request.urlopen(url) as response:
+        return json.loads(response.read())
+
+def RunSize(size, args):
+    server, url = StartMockServer(size, args)
+    try:
+        with tempfile.TemporaryDirectory() as workDir:
+            command = [sys.executable, os.path.abspath(__file__), '--child', '--url', url]
+            for setting in args.settings:
+                command += ['--set', setting]
+            child = subprocess.run(command, cwd=workDir, capture_output=True, text=True)
+            if child.returncode != 0 or not child.stdout.strip():
+                raise SystemExit(f'Audit run failed for {size} devices:\n{child.stderr}')
+            result = json.loads(child.stdout.strip().splitlines()[-1])
+        stats = GetJson(url + '/_mock/stats')
+    finally:
+        server.terminate()
+        server.wait()
+    result.update({'devices': size, 'requests': stats['requests'], 'errors_injected': stats['errors_injected'],
+                   'bytes_received': stats['bytes_sent'], 'requests_by_endpoint': stats['by_endpoint']})
+    return result
+
+def PrintResults(results):
+    print(f"{'devices':>9} {'status':>7} {'wall s':>9} {'requests':>9} {'MB recv':>9} {'peak RSS MB':>12}")
+    for result in results:
+        peak = f"{result['peak_rss_mb']:.1f}" if result['peak_rss_mb'] is not None else 'n/a'
+        print(f"{result['devices']:>9} {result['status']:>7} {result['wall_time']:>9.2f} {result['requests']:>9} "
+              f"{result['bytes_received'] / 1048576:>9.1f} {peak:>12}")
+
+def main(argv=None):
+    args = ParseArgs(argv)
+    if args.child:
+        return RunChild(args)
+    results = []
+    for size in args.sizes:
+        print(f'Running audit against {size} mock devices...', flush=True)
+        results.append(RunSize(size, args))
+    PrintResults(results)
+    if args.jsonFile:
+        with open(args.jsonFile, 'w') as jsonFile:
+            json.dump({'settings': args.settings, 'latency': args.latency, 'error_rate': args.error_rate, 'results': results}, jsonFile, indent=2)
+
+if __name__ == '__main__':
+    main()
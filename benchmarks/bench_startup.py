@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+########################################################################################################################
+## Startup benchmark:  measures how long a fresh interpreter takes to load XIQ-Audit-Mismatch-Alerts_v2a.py (imports and
+## module-level setup, main() is not run) and checks that optional-feature modules are not imported at load time.
+## It also checks that neither loading the script nor its email sender entry point (--drain-outbox) prompts for credentials,
+## since the sender runs detached with no terminal.  Exits with status 1 when the median load time is above --max-ms, a
+## forbidden module was imported or something prompted, so it can guard against cold start regressions.
+########################################################################################################################
+## Examples:
+##   python3 benchmarks/bench_startup.py
+##   python3 benchmarks/bench_startup.py --runs 20 --max-ms 250
+########################################################################################################################
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+
+##Modules that belong to optional features and must only be imported when the feature runs
+lazyModules = ['pandas', 'asyncio', 'smtplib', 'email.mime.multipart', 'concurrent.futures', 'sqlite3', 'pyarrow', 'cProfile', 'tracemalloc']
+
+##Any credential prompt during the measured code fails the child instead of waiting on stdin
+noPromptCode = '''
+import builtins, getpass
+def NoPrompt(*args, **kwargs):
+    raise SystemExit('prompted for input: ' + repr(args))
+builtins.input = NoPrompt
+getpass.getpass = NoPrompt
+'''
+
+childCode = noPromptCode + '''
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {benchDir!r})
+from audit_script import LoadAuditScript
+LoadAuditScript()
+loadTime = time.perf_counter() - start
+print(json.dumps({{'load_ms': loadTime * 1000, 'modules': sorted(sys.modules)}}))
+'''
+
+##Runs --drain-outbox with prompt authentication (empty token/username) on an empty outbox in a temporary script directory
+drainCode = noPromptCode + '''
+import sys, tempfile
+sys.path.insert(0, {benchDir!r})
+from audit_script import LoadAuditScript
+audit = LoadAuditScript()
+audit.XIQ_Token = audit.XIQ_username = audit.XIQ_password = ''
+sys.argv = ['XIQ-Audit-Mismatch-Alerts_v2a.py', '--drain-outbox']
+with tempfile.TemporaryDirectory() as workDir:
+    audit.PATH = workDir
+    audit.main()
+'''
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the cold start of the XIQ audit script')
+    parser.add_argument('--runs', type=int, default=10, help='number of fresh interpreters to measure')
+    parser.add_argument('--max-ms', type=float, default=None, help='fail when the median load time is above this many milliseconds')
+    parser.add_argument('--importtime', action='store_true', help='also print the slowest imports reported by python -X importtime')
+    return parser.parse_args(argv)
+
+##Error output of the --drain-outbox check, None when the sender ran without prompting
+def CheckDrainEntryPoint():
+    child = subprocess.run([sys.executable, '-c', drainCode.format(benchDir=benchDir)], capture_output=True, text=True, stdin=subprocess.DEVNULL)
+    return None if child.returncode == 0 else (child.stderr.strip() or child.stdout.strip())
+
+def MeasureOnce():
+    child = subprocess.run([sys.executable, '-c', childCode.format(benchDir=benchDir)], capture_output=True, text=True)
+    if child.returncode != 0:
+        raise SystemExit(f'Loading the script failed:\n{child.stderr}')
+    return json.loads(child.stdout.strip().splitlines()[-1])
+
+##Slowest cumulative imports from python -X importtime
+def PrintSlowestImports(limit=10):
+    child = subprocess.run([sys.executable, '-X', 'importtime', '-c', childCode.format(benchDir=benchDir)], capture_output=True, text=True)
+    rows = []
+    for line in child.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].rstrip()))
+    print('Slowest imports (cumulative):')
+    for cumulative, name in sorted(rows, reverse=True)[:limit]:
+        print(f'  {cumulative / 1000:8.1f} ms  {name}')
+
+def main(argv=None):
+    args = ParseArgs(argv)
+    loadTimes = []
+    modules = []
+    for _ in range(max(1, args.runs)):
+        result = MeasureOnce()
+        loadTimes.append(result['load_ms'])
+        modules = result['modules']
+    median = statistics.median(loadTimes)
+    print(f'Script load time over {len(loadTimes)} runs:  median {median:.1f} ms  min {min(loadTimes):.1f} ms  max {max(loadTimes):.1f} ms')
+    if args.importtime:
+        PrintSlowestImports()
+    failed = False
+    eagerModules = [module for module in lazyModules if module in modules]
+    if eagerModules:
+        print('FAIL: optional-feature modules imported at load time: ' + ', '.join(eagerModules))
+        failed = True
+    drainError = CheckDrainEntryPoint()
+    if drainError is not None:
+        print('FAIL: the --drain-outbox entry point did not run without a prompt: ' + drainError.splitlines()[-1])
+        failed = True
+    if args.max_ms is not None and median > args.max_ms:
+        print(f'FAIL: median load time {median:.1f} ms is above --max-ms {args.max_ms:.1f} ms')
+        failed = True
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
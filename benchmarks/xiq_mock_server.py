@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+########################################################################################################################
+## Local fake XIQ API used to load-test XIQ-Audit-Mismatch-Alerts without touching a production tenant
+## Serves the endpoints the audit script calls with the same JSON shapes XIQ returns:
+##   POST /login, GET /devices, GET /ccgs, GET/PUT /ccgs/{id}, POST /deployments
+## Plus two helper endpoints for benchmarks:  GET /_mock/stats (request counters) and POST /_mock/reset
+########################################################################################################################
+## Example:  python3 benchmarks/xiq_mock_server.py --devices 10000 --latency 0.05 --error-rate 0.01
+## Then point the audit script at it by setting URL = "http://127.0.0.1:8765"
+########################################################################################################################
+
+fullOnlyFields = {'locations', 'thread0_eui64', 'thread0_ext_mac', 'active_clients', 'iqagent_version', 'domain_name',
+                  'primary_ntp_server_address', 'primary_dns_server_address', 'subnet_mask', 'default_gateway', 'ipv6_address', 'ipv6_netmask'}
+baseDeviceId = 100000000  #Device IDs are baseDeviceId + fleet index so lookups by ID never need a scan
+ccgBaseId = 5000000
+
+##Fleet and behaviour of the fake tenant.  Devices are generated on demand from their index so 100k devices cost almost no memory.
+class MockFleet:
+    def __init__(self, deviceCount, offlineRatio=0.25, mismatchRatio=0.5, ccgName='UpdateOfflineDevices', ccgCount=50,
+                 ccgMemberRatio=0.02, latency=0.0, latencyJitter=0.0, errorRate=0.0, errorCodes=(500, 502, 503), seed=1,
+                 supportsFields=True, tokenLifetime=86400, errorEndpoints=(), rateLimit=0):
+        self.deviceCount = deviceCount
+        self.rateLimit = rateLimit  #requests per second accepted before answering 429, 0 = unlimited
+        self.rateWindow = [0, 0]  #start second and requests accepted in it
+        self.errorEndpoints = set(errorEndpoints)  #empty injects errors on every endpoint
+        self.tokenLifetime = tokenLifetime
+        self.issuedTokens = {}  #tokens handed out by /login and their expiry
+        self.supportsFields = supportsFields
+        self.latency = latency
+        self.latencyJitter = latencyJitter
+        self.errorRate = errorRate
+        self.errorCodes = tuple(errorCodes)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        rng = random.Random(seed)
+        self.connected = bytearray(1 if rng.random() >= offlineRatio else 0 for _ in range(deviceCount))
+        self.mismatch = bytearray(1 if rng.random() < mismatchRatio else 0 for _ in range(deviceCount))
+        self.queryCache = {}
+        self.ccgs = []
+        for index in range(ccgCount):
+            self.ccgs.append({'id': ccgBaseId + index, 'name': f'MockGroup{index:04d}', 'description': '', 'device_ids': []})
+        ##The update CCG holds a SIM device plus a sample of the fleet, online and offline
+        memberEvery = max(1, int(1 / ccgMemberRatio)) if ccgMemberRatio > 0 else 0
+        memberIds = [baseDeviceId + index for index in range(0, deviceCount, memberEvery)] if memberEvery else []
+        ##Several comma separated update CCG names share the sample round robin
+        updateNames = [name for name in ccgName.split(',') if name]
+        for offset, name in enumerate(updateNames):
+            self.ccgs.insert(len(self.ccgs) // 2, {'id': ccgBaseId + ccgCount + offset, 'name': name, 'description': '',
+                                                   'device_ids': [1] + memberIds[offset::len(updateNames)]})
+        self.deployedIds = 0
+        self.ResetStats()
+
+    def ResetStats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'errors_injected': 0, 'throttled': 0, 'bytes_sent': 0, 'by_endpoint': {}}
+
+    def CountRequest(self, endpoint):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['by_endpoint'][endpoint] = self.stats['by_endpoint'].get(endpoint, 0) + 1
+
+    def InjectError(self, endpoint):
+        if self.errorEndpoints and endpoint not in self.errorEndpoints:
+            return None
+        with self.lock:
+            if self.errorRate and self.random.random() < self.errorRate:
+                self.stats['errors_injected'] += 1
+                return self.random.choice(self.errorCodes)
+        return None
+
+    ##Fixed one second window rate limit like the XIQ API gateway.  Returns the Retry-After seconds when the request is over the limit.
+    def Throttle(self):
+        if not self.rateLimit:
+            return None
+        with self.lock:
+            now = time.time()
+            second = int(now)
+            if self.rateWindow[0] != second:
+                self.rateWindow = [second, 0]
+            if self.rateWindow[1] >= self.rateLimit:
+                self.stats['throttled'] += 1
+                return max(1, int(second + 1 - now + 0.999))
+            self.rateWindow[1] += 1
+        return None
+
+    def Delay(self):
+        if self.latency or self.latencyJitter:
+            with self.lock:
+                jitter = self.random.uniform(0, self.latencyJitter) if self.latencyJitter else 0
+            time.sleep(self.latency + jitter)
+
+    ##Full XIQ device object (views=FULL) for the device at a fleet index
+    def BuildDevice(self, index):
+        deviceId = baseDeviceId + index
+        connected = bool(self.connected[index])
+        device = {
+            'id': deviceId,
+            'create_time': '2023-01-15T10:00:00.000+0000',
+            'update_time': '2024-06-01T12:00:00.000+0000',
+            'org_id': 0,
+            'serial_number': f'MOCK{index:010d}',
+            'service_tag': '',
+            'mac_address': f'4C231A{index:06X}',
+            'device_function': 'AP',
+            'product_type': ('AP_3000', 'AP_5010', 'AP_302W', 'AP_4000')[index % 4],
+            'hostname': f'MockAP-{index:06d}',
+            'ip_address': f'10.{(index >> 16) & 255}.{(index >> 8) & 255}.{index & 255}',
+            'software_version': ('10.6.5.0', '10.6.6.0', '10.6.7.0')[index % 3],
+            'device_admin_state': 'MANAGED',
+            'connected': connected,
+            'last_connect_time': '2024-06-11T19:42:16.000+0000',
+            'network_policy_name': f'Policy-{index % 20}',
+            'network_policy_id': 7000 + index % 20,
+            'primary_ntp_server_address': '',
+            'primary_dns_server_address': '10.0.0.53',
+            'subnet_mask': '255.255.0.0',
+            'default_gateway': '10.0.0.1',
+            'ipv6_address': '',
+            'ipv6_netmask': '',
+            'simulated': False,
+            'display_version': '',
+            'location_id': 9000 + index % 500,
+            'locations': [
+                {'id': 1, 'name': 'Global'},
+                {'id': 2, 'name': 'Mock Site'},
+                {'id': 3 + index % 100, 'name': f'Building {index % 100}'},
+                {'id': 200 + index % 5, 'name': f'Floor {index % 5}'}],
+            'country_code': 840,
+            'description': '',
+            'function': 'AP',
+            'system_up_time': 86400 + index,
+            'config_mismatch': bool(self.mismatch[index]),
+            'managed_by': 'XIQ',
+            'thread0_eui64': '',
+            'thread0_ext_mac': '',
+            'active_clients': index % 40,
+            'iqagent_version': '',
+            'domain_name': 'mock.local',
+        }
+        ##Every 50th device has no location and every 97th offline device looks like a Site Engine device with missing keys
+        if index % 50 == 0:
+            device['locations'] = []
+        if not connected and index % 97 == 0:
+            for key in ('device_function', 'ip_address', 'last_connect_time'):
+                device.pop(key, None)
+        return device
+
+    ##Apply views= and fields= to a device.  BASIC omits the FULL-only keys (locations among them), fields= keeps only the named keys.
+    def ProjectDevice(self, device, query):
+        fields = query.get('fields')
+        if fields and self.supportsFields:
+            wanted = {field.lower() for value in fields for field in value.split(',')}
+            return {key: value for key, value in device.items() if key in wanted}
+        if query.get('views', ['BASIC'])[0] != 'FULL':
+            return {key: value for key, value in device.items() if key not in fullOnlyFields}
+        return device
+
+    ##Fleet indexes matching a /devices query, cached per filter combination
+    def MatchDevices(self, query):
+        if 'ids' in query:
+            ids = []
+            for value in query['ids']:
+                ids.extend(int(item) for item in value.split(',') if item)
+            indexes = [deviceId - baseDeviceId for deviceId in ids if 0 <= deviceId - baseDeviceId < self.deviceCount]
+        else:
+            indexes = None
+        connected = query.get('connected', [None])[0]
+        mismatch = query.get('configMismatch', [None])[0]
+        if indexes is None:
+            key = (connected, mismatch)
+            with self.lock:
+                cached = self.queryCache.get(key)
+            if cached is not None:
+                return cached
+            indexes = range(self.deviceCount)
+        else:
+            key = None
+        if connected is not None:
+            wanted = 1 if connected == 'true' else 0
+            indexes = [index for index in indexes if self.connected[index] == wanted]
+        if mismatch is not None:
+            wanted = 1 if mismatch == 'true' else 0
+            indexes = [index for index in indexes if self.mismatch[index] == wanted]
+        indexes = list(indexes)
+        if key is not None:
+            with self.lock:
+                self.queryCache[key] = indexes
+        return indexes
+
+    def IssueToken(self):
+        with self.lock:
+            token = f'mock-token-{len(self.issuedTokens) + 1}-{random.getrandbits(32):08x}'
+            self.issuedTokens[token] = time.time() + self.tokenLifetime
+        return token
+
+    ##Static API tokens are always accepted, tokens from /login only until they expire (unknown ones are rejected)
+    def TokenValid(self, token):
+        if not token.startswith('mock-token-'):
+            return True
+        with self.lock:
+            return time.time() < self.issuedTokens.get(token, 0)
+
+    def Deploy(self, deviceIds):
+        with self.lock:
+            self.deployedIds += len(deviceIds)
+
+##Paged response envelope used by every XIQ list API
+def PagedResponse(items, page, limit):
+    totalCount = len(items)
+    totalPages = max(1, -(-totalCount // limit)) if limit else 1
+    pageItems = items[(page - 1) * limit:page * limit]
+    return {'page': page, 'count': len(pageItems), 'total_pages': totalPages, 'total_count': totalCount, 'data': pageItems}
+
+class MockXiqHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  #keep-alive, like the real API
+    fleet = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def SendJson(self, body, status=200, extraHeaders=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (extraHeaders or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        with self.fleet.lock:
+            self.fleet.stats['bytes_sent'] += len(payload)
+
+    def ReadJson(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    ##Shared request preamble: count, delay, inject errors and check authorization.  Returns True when the request was answered.
+    def Preamble(self, endpoint, needsAuth=True):
+        fleet = self.fleet
+        fleet.CountRequest(endpoint)
+        retryAfter = fleet.Throttle()
+        if retryAfter:
+            self.SendJson({'error_code': 'TOO_MANY_REQUESTS', 'error_message': 'Rate limit exceeded'}, 429, {'Retry-After': str(retryAfter)})
+            return True
+        fleet.Delay()
+        errorCode = fleet.InjectError(endpoint)
+        if errorCode:
+            self.SendJson({'error_code': 'MOCK_INJECTED', 'error_message': f'Injected HTTP {errorCode}'}, errorCode,
+                          {'Retry-After': '1'} if errorCode == 429 else None)
+            return True
+        authorization = self.headers.get('Authorization', '')
+        if needsAuth and not (authorization.startswith('Bearer ') and fleet.TokenValid(authorization[7:])):
+            self.SendJson({'error_code': 'UNAUTHENTICATED', 'error_message': 'Missing, unknown or expired bearer token'}, 401)
+            return True
+        return False
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        page = int(query.get('page', ['1'])[0])
+        limit = int(query.get('limit', ['10'])[0])
+        if parsed.path == '/_mock/stats':
+            with self.fleet.lock:
+                stats = json.loads(json.dumps(self.fleet.stats))
+            stats['deployed_ids'] = self.fleet.deployedIds
+            return self.SendJson(stats)
+        if parsed.path == '/devices':
+            if self.Preamble('/devices'):
+                return
+            indexes = self.fleet.MatchDevices(query)
+            body = PagedResponse(indexes, page, limit)
+            body['data'] = [self.fleet.ProjectDevice(self.fleet.BuildDevice(index), query) for index in body['data']]
+            return self.SendJson(body)
+        if parsed.path == '/ccgs':
+            if self.Preamble('/ccgs'):
+                return
+            return self.SendJson(PagedResponse(self.fleet.ccgs, page, limit))
+        match = re.fullmatch(r'/ccgs/(\d+)', parsed.path)
+        if match:
+            if self.Preamble('/ccgs/{id}'):
+                return
+            for ccg in self.fleet.ccgs:
+                if ccg['id'] == int(match.group(1)):
+                    return self.SendJson(ccg)
+            return self.SendJson({'error_code': 'NOT_FOUND', 'error_message': 'CCG not found'}, 404)
+        self.SendJson({'error_code': 'NOT_FOUND', 'error_message': parsed.path}, 404)
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        if parsed.path == '/_mock/reset':
+            self.fleet.ResetStats()
+            return self.SendJson({})
+        if parsed.path == '/login':
+            self.ReadJson()
+            if self.Preamble('/login', needsAuth=False):
+                return
+            return self.SendJson({'access_token': self.fleet.IssueToken(), 'token_type': 'Bearer', 'expires_in': self.fleet.tokenLifetime})
+        if parsed.path == '/deployments':
+            body = self.ReadJson()
+            if self.Preamble('/deployments'):
+                return
+            self.fleet.Deploy(body.get('devices', {}).get('ids', []))
+            return self.SendJson({})
+        self.ReadJson()
+        self.SendJson({'error_code': 'NOT_FOUND', 'error_message': parsed.path}, 404)
+
+    def do_PUT(self):
+        parsed = urlparse(self.path)
+        body = self.ReadJson()
+        match = re.fullmatch(r'/ccgs/(\d+)', parsed.path)
+        if not match:
+            return self.SendJson({'error_code': 'NOT_FOUND', 'error_message': parsed.path}, 404)
+        if self.Preamble('/ccgs/{id}'):
+            return
+        for ccg in self.fleet.ccgs:
+            if ccg['id'] == int(match.group(1)):
+                with self.fleet.lock:
+                    ccg['name'] = body.get('name', ccg['name'])
+                    ccg['description'] = body.get('description', ccg['description'])
+                    ccg['device_ids'] = list(body.get('device_ids', ccg['device_ids']))
+                return self.SendJson(ccg)
+        self.SendJson({'error_code': 'NOT_FOUND', 'error_message': 'CCG not found'}, 404)
+
+##Start the mock server, serving from a background thread when background=True
+def StartMockServer(fleet, host='127.0.0.1', port=8765, background=False):
+    handler = type('BoundMockXiqHandler', (MockXiqHandler,), {'fleet': fleet})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Fake XIQ API for load-testing XIQ-Audit-Mismatch-Alerts')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--devices', type=int, default=1000, help='fleet size')
+    parser.add_argument('--offline-ratio', type=float, default=0.25)
+    parser.add_argument('--mismatch-ratio', type=float, default=0.5, help='share of devices with an audit mismatch')
+    parser.add_argument('--ccg-name', default='UpdateOfflineDevices', help='update CCG name, comma separated for several update CCGs')
+    parser.add_argument('--ccg-count', type=int, default=50, help='number of other CCGs in the tenant')
+    parser.add_argument('--ccg-member-ratio', type=float, default=0.02, help='share of the fleet in the update CCG')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API response')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='random extra seconds (0..jitter) per response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API requests answered with an error')
+    parser.add_argument('--error-codes', default='500,502,503', help='comma separated HTTP codes used for injected errors')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--error-endpoints', default='', help='comma separated endpoints that get injected errors, e.g. /deployments (default: all)')
+    parser.add_argument('--rate-limit', type=int, default=0, help='requests per second accepted before answering 429 with Retry-After (default: unlimited)')
+    parser.add_argument('--token-lifetime', type=int, default=86400, help='seconds a token from /login stays valid (expires_in)')
+    parser.add_argument('--no-fields', action='store_true', help='ignore the fields= query parameter like an API without field projection')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = ParseArgs(argv)
+    fleet = MockFleet(args.devices, args.offline_ratio, args.mismatch_ratio, args.ccg_name, args.ccg_count,
+                      args.ccg_member_ratio, args.latency, args.latency_jitter, args.error_rate,
+                      [int(code) for code in args.error_codes.split(',') if code], args.seed, not args.no_fields, args.token_lifetime,
+                      [endpoint for endpoint in args.error_endpoints.split(',') if endpoint], args.rate_limit)
+    server = StartMockServer(fleet, args.host, args.port)
+    print(f'Mock XIQ API serving {args.devices} devices on http://{args.host}:{server.server_address[1]}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()